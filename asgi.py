@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# ASGI entry point for running the pipeline as a long-lived service, where the
+# warm thread pools, caches and keep-alive connections pay off across
+# requests. Same routes and responses as server.py (see routes.py), with the
+# admission queue's counters added to GET /healthz.
+#
+# Worker model: SERVER_WORKERS processes (uvicorn workers, each with its own
+# caches unless a shared cache backend is configured), each running the
+# blocking pipeline on SERVER_CONCURRENCY threads. Generate requests beyond
+# that wait in a bounded queue of SERVER_QUEUE_SIZE; when it is full, or a
+# request has waited SERVER_QUEUE_TIMEOUT seconds, the request is shed with a
+# 503 and Retry-After instead of piling up behind work the server can't finish.
+# Job status, results and images are cheap and skip the queue.
+#
+#   pip install uvicorn
+#   python asgi.py --host 0.0.0.0 --port 8080 --workers 2 --concurrency 8 --queue-size 16
+
+import argparse
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import lambda_function
+import routes
+
+logger = logging.getLogger()
+
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '1'))
+SERVER_CONCURRENCY = int(os.environ.get('SERVER_CONCURRENCY', '8'))
+SERVER_QUEUE_SIZE = int(os.environ.get('SERVER_QUEUE_SIZE', '16'))
+SERVER_QUEUE_TIMEOUT = float(os.environ.get('SERVER_QUEUE_TIMEOUT', '30'))
+SERVER_RETRY_AFTER = int(os.environ.get('SERVER_RETRY_AFTER', '5'))
+
+pipeline_pool = ThreadPoolExecutor(max_workers=SERVER_CONCURRENCY, thread_name_prefix='server')
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionQueue:
+    # At most `concurrency` requests run at once and `queue_size` wait for a
+    # slot; everything else is refused straight away. Only touched from the
+    # event loop, so the counters need no lock.
+    def __init__(self, concurrency: int, queue_size: int, timeout: float):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self.served = 0
+        self.shed = 0
+        self._slots = None
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._slots is None:
+            # Created on first use so it belongs to the serving event loop.
+            self._slots = asyncio.Semaphore(self.concurrency)
+        if self._slots.locked() and self.waiting >= self.queue_size:
+            self.shed += 1
+            raise Overloaded("request queue is full")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            raise Overloaded(f"no worker free within {self.timeout:g}s")
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.served += 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'queueSize': self.queue_size,
+            'running': self.running,
+            'waiting': self.waiting,
+            'served': self.served,
+            'shed': self.shed,
+        }
+
+
+admission = AdmissionQueue(SERVER_CONCURRENCY, SERVER_QUEUE_SIZE, SERVER_QUEUE_TIMEOUT)
+
+
+async def start_response(send, status: int, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()],
+    })
+
+
+async def send_result(send, result):
+    status, headers, data = routes.encode_result(result)
+    await start_response(send, status, headers)
+    await send({'type': 'http.response.body', 'body': data})
+
+
+async def read_body(receive) -> str:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks).decode('utf-8')
+
+
+async def run_blocking(fn, *args, executor=None):
+    # Generation runs on pipeline_pool; quick lookups use the loop's default
+    # executor so they aren't stuck behind it.
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+async def shed(send, e):
+    logger.warning(f"Shedding request: {str(e)}")
+    await send_result(send, routes.json_result(
+        503, {'error': f"Server is busy ({str(e)}), retry later"}, {'Retry-After': SERVER_RETRY_AFTER}
+    ))
+
+
+async def generate(route, receive, send):
+    body = await read_body(receive)
+    try:
+        async with admission.slot():
+            result = await run_blocking(routes.respond, route, body, executor=pipeline_pool)
+    except Overloaded as e:
+        await shed(send, e)
+        return
+    await send_result(send, result)
+
+
+async def stream_events(headers, receive, send):
+    request, error = routes.stream_request(await read_body(receive))
+    if error:
+        await send_result(send, routes.json_result(400, {'error': error}))
+        return
+    try:
+        async with admission.slot():
+            await relay_events(request, routes.stream_content_type(headers), receive, send)
+    except Overloaded as e:
+        await shed(send, e)
+
+
+async def relay_events(request, content_type: str, receive, send):
+    # The pipeline's event generator runs on a worker thread and hands each
+    # event to the event loop; the worker stops at the next event once the
+    # client has gone.
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    disconnected = threading.Event()
+    done = object()
+    sse = content_type == 'text/event-stream'
+
+    def produce():
+        generator = routes.stream_events(request)
+        try:
+            for event in generator:
+                if disconnected.is_set():
+                    generator.close()
+                    return
+                loop.call_soon_threadsafe(events.put_nowait, event)
+        except Exception as e:
+            logger.error(f"Unexpected error while streaming: {str(e)}", exc_info=True)
+            loop.call_soon_threadsafe(events.put_nowait, {'event': 'error', 'error': str(e)})
+        finally:
+            loop.call_soon_threadsafe(events.put_nowait, done)
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    await start_response(send, 200, {
+        'Content-Type': content_type,
+        'Cache-Control': 'no-cache',
+        **routes.cors_headers(),
+    })
+    watcher = asyncio.ensure_future(watch_disconnect())
+    producer = loop.run_in_executor(pipeline_pool, produce)
+    try:
+        while True:
+            event = await events.get()
+            if event is done:
+                break
+            await send({'type': 'http.response.body', 'body': routes.format_event(event, sse), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        logger.info("Client disconnected from event stream")
+        disconnected.set()
+    finally:
+        watcher.cancel()
+        # Keep the slot until the worker thread has actually stopped.
+        await producer
+
+
+async def http_app(scope, receive, send):
+    route = routes.match(scope['method'], scope['path'])
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    if route.name == 'options':
+        await send_result(send, {'statusCode': 204, 'body': ''})
+    elif route.name == 'health':
+        await send_result(send, routes.json_result(200, {'admission': admission.stats(), **routes.health()}))
+    elif route.name == 'generate':
+        await generate(route, receive, send)
+    elif route.name == 'stream':
+        await stream_events(headers, receive, send)
+    else:
+        # Job status, results, images and job submission are quick.
+        body = await read_body(receive) if scope['method'] == 'POST' else ''
+        await send_result(send, await run_blocking(routes.respond, route, body, headers))
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # A long-lived process pays for the clients once, before traffic.
+            await run_blocking(lambda_function.warm_up)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            pipeline_pool.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        await http_app(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the blog pipeline over ASGI.')
+    parser.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', '8080')))
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS, help='worker processes')
+    parser.add_argument('--concurrency', type=int, default=SERVER_CONCURRENCY, help='pipeline threads per worker')
+    parser.add_argument('--queue-size', type=int, default=SERVER_QUEUE_SIZE, help='requests waiting per worker')
+    parser.add_argument('--queue-timeout', type=float, default=SERVER_QUEUE_TIMEOUT)
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("asgi.py needs an ASGI server: pip install uvicorn")
+    # Worker processes import this module afresh and read their settings from
+    # the environment.
+    os.environ.update(
+        SERVER_CONCURRENCY=str(args.concurrency),
+        SERVER_QUEUE_SIZE=str(args.queue_size),
+        SERVER_QUEUE_TIMEOUT=str(args.queue_timeout),
+    )
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run('asgi:app', host=args.host, port=args.port, workers=args.workers, log_level='info')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Batch generation for catalogs of drugs.
+#
+#   python batch.py drugs.jsonl --output posts.jsonl --checkpoint posts.ckpt.sqlite3 \
+#       --workers 8 --brave-concurrency 2 --anthropic-concurrency 6 --stability-concurrency 2
+#
+# Input is JSONL or CSV with drugName and drugDetails. Every finished stage is
+# written to the checkpoint, so rerunning the same command after an
+# interruption skips completed drugs and resumes the others from their last
+# finished stage. Searches and page fetches shared between drugs are made
+# once: concurrent duplicates are coalesced and later ones hit the caches.
+
+import argparse
+import csv
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import monotonic
+
+import lambda_function
+from cache import SQLiteCache
+
+logger = logging.getLogger()
+
+
+def load_items(path: str):
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    items = []
+    for line_number, row in enumerate(rows, start=1):
+        if not row.get('drugName') or 'drugDetails' not in row:
+            raise KeyError(f"Row {line_number}: 'drugName' or 'drugDetails' missing")
+        items.append({'drugName': row['drugName'], 'drugDetails': row['drugDetails'] or ''})
+    return items
+
+
+class BatchRunner:
+    def __init__(self, output_path: str, checkpoint_path: str, image_mode: str = None):
+        self.output_path = output_path
+        self.image_mode = image_mode or lambda_function.IMAGE_MODE
+        if self.image_mode not in lambda_function.IMAGE_MODES:
+            raise ValueError(f"image_mode must be one of {list(lambda_function.IMAGE_MODES)}")
+        # No TTL and no eviction: the checkpoint must outlive the run.
+        self.checkpoint = SQLiteCache(name='checkpoint', path=checkpoint_path, ttl=0, max_entries=10 ** 9)
+        self.output_lock = threading.Lock()
+
+    def run_item(self, item):
+        drug_name = item['drugName']
+        drug_details = item['drugDetails']
+        item_key = lambda_function.request_key(drug_name, drug_details, self.image_mode)
+        if self.checkpoint.get(f"{item_key}:done"):
+            return 'skipped'
+
+        # The checkpoint stands in for the stage cache, so a rerun resumes each
+        # drug from its last finished stage.
+        response_body = lambda_function.generate_blog(
+            drug_name, drug_details, image_mode=self.image_mode, cache=self.checkpoint
+        )
+        complete = lambda_function.is_cacheable(response_body)
+        with self.output_lock:
+            with open(self.output_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'drugName': drug_name, 'complete': complete, **response_body}) + '\n')
+        if complete:
+            self.checkpoint.set(f"{item_key}:done", True)
+            return 'completed'
+        return 'incomplete'
+
+    def run(self, items, workers: int = 4):
+        started = monotonic()
+        counts = {'completed': 0, 'skipped': 0, 'incomplete': 0, 'failed': 0}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch') as pool:
+            futures = {pool.submit(self.run_item, item): item for item in items}
+            for future in as_completed(futures):
+                drug_name = futures[future]['drugName']
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    logger.error(f"Batch item {drug_name} failed: {str(e)}", exc_info=True)
+                    outcome = 'failed'
+                counts[outcome] += 1
+                logger.info(f"{drug_name}: {outcome} ({sum(counts.values())}/{len(items)})")
+        return {
+            **counts,
+            'total': len(items),
+            'seconds': round(monotonic() - started, 1),
+            'searchCache': lambda_function.search_cache.stats.as_dict(),
+            'pageCache': lambda_function.page_cache.stats.as_dict(),
+            'imageCache': lambda_function.image_cache.stats.as_dict(),
+        }
+
+
+def run_batch(items, output_path: str, checkpoint_path: str = None, workers: int = 4, image_mode: str = None,
+              brave_concurrency: int = None, anthropic_concurrency: int = None, stability_concurrency: int = None):
+    limits = {
+        'brave': brave_concurrency,
+        'anthropic': anthropic_concurrency,
+        'stability': stability_concurrency,
+    }
+    lambda_function.set_service_concurrency(**{name: limit for name, limit in limits.items() if limit})
+    checkpoint_path = checkpoint_path or f"{output_path}.ckpt.sqlite3"
+    return BatchRunner(output_path, checkpoint_path, image_mode=image_mode).run(items, workers=workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate blog posts for a catalog of drugs.')
+    parser.add_argument('input', help='JSONL or CSV file with drugName and drugDetails')
+    parser.add_argument('--output', required=True, help='JSONL file results are appended to')
+    parser.add_argument('--checkpoint', help='checkpoint database (default: <output>.ckpt.sqlite3)')
+    parser.add_argument('--workers', type=int, default=4, help='drugs processed at the same time')
+    parser.add_argument('--image-mode', choices=lambda_function.IMAGE_MODES)
+    parser.add_argument('--brave-concurrency', type=int)
+    parser.add_argument('--anthropic-concurrency', type=int)
+    parser.add_argument('--stability-concurrency', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    summary = run_batch(
+        load_items(args.input),
+        args.output,
+        checkpoint_path=args.checkpoint,
+        workers=args.workers,
+        image_mode=args.image_mode,
+        brave_concurrency=args.brave_concurrency,
+        anthropic_concurrency=args.anthropic_concurrency,
+        stability_concurrency=args.stability_concurrency
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Cold-start benchmark: import time and first/second request latency of
+# lambda_function in fresh interpreters, with lazy and eager initialization.
+#
+#   python benchmarks/bench_coldstart.py --runs 5 --latency anthropic=200,brave=50,pages=20
+#
+# Each run starts a new Python process, so module caches, clients and
+# connection pools are all cold. Upstream calls go to benchmarks/stubs.py and
+# the pipeline caches are disabled, so the first request exercises every stage.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import stubs  # noqa: E402
+
+MODES = {'lazy': 'true', 'eager': 'false'}
+
+CHILD = """
+import json, logging, sys
+from time import perf_counter
+logging.disable(logging.INFO)
+started = perf_counter()
+import lambda_function
+imported = perf_counter()
+def request(drug):
+    body = json.dumps({'drugName': drug, 'drugDetails': 'A once-daily oral medication.'})
+    return lambda_function.lambda_handler({'body': body}, None)['statusCode']
+first_status = request('coldstart-first')
+first = perf_counter()
+second_status = request('coldstart-second')
+second = perf_counter()
+print(json.dumps({
+    'importMs': (imported - started) * 1000,
+    'firstRequestMs': (first - imported) * 1000,
+    'secondRequestMs': (second - first) * 1000,
+    'modules': len(sys.modules),
+    'ok': first_status == 200 and second_status == 200,
+}))
+"""
+
+
+def run_child(env, importtime: bool = False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD]
+    result = subprocess.run(command, cwd=REPO_DIR, env=env, capture_output=True, text=True, timeout=600)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'child failed')
+    # The pipeline prints progress; the measurements are the last line.
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_log: str, top: int):
+    # Modules imported directly by lambda_function (or by the warm-up it runs),
+    # by cumulative time, from `python -X importtime`.
+    packages = []
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            packages.append((int(cumulative) / 1000, name.strip()))
+    return sorted(packages, reverse=True)[:top]
+
+
+def summarize(runs, field: str) -> str:
+    values = [run[field] for run in runs]
+    return f"{statistics.median(values):9.1f} {max(values):9.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold-start import and first-request latency.')
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per mode')
+    parser.add_argument('--modes', default='lazy,eager', help='comma-separated, from: lazy, eager')
+    parser.add_argument('--top-imports', type=int, default=8, help='slowest imports to list (0 to skip)')
+    parser.add_argument('--json', help='also write the results to this file')
+    stubs.add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server = stubs.start_stub_server(stubs.config_from_args(args))
+    base_env = {
+        **os.environ,
+        **stubs.stub_environment(f"http://127.0.0.1:{server.server_port}"),
+        'CACHE_BACKEND': 'none',
+        'BRAVE_QPS': '1000',
+        'BRAVE_BURST': '1000',
+    }
+
+    results = {}
+    print(f"{'mode':<8}{'import ms':>19}{'1st request ms':>19}{'2nd request ms':>19}{'modules':>9}")
+    print(f"{'':<8}" + f"{'median':>10}{'max':>9}" * 3)
+    for mode in [mode.strip() for mode in args.modes.split(',') if mode.strip()]:
+        env = {**base_env, 'LAZY_INIT': MODES[mode]}
+        runs = [run_child(env)[0] for _ in range(args.runs)]
+        failed = sum(not run['ok'] for run in runs)
+        results[mode] = runs
+        print(f"{mode:<8}{summarize(runs, 'importMs')}{summarize(runs, 'firstRequestMs')}"
+              f"{summarize(runs, 'secondRequestMs')}{runs[0]['modules']:>9}"
+              + (f"  ({failed} failed)" if failed else ''))
+
+    if args.top_imports:
+        _, log = run_child({**base_env, 'LAZY_INIT': 'false'}, importtime=True)
+        print("\nSlowest imports under lambda_function (eager, cumulative ms):")
+        for ms, name in slowest_imports(log, args.top_imports):
+            print(f"  {ms:8.1f}  {name}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
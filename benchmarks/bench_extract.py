@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Compares the old page extraction (full download + BeautifulSoup get_text) with
+# the streaming extractor used by get_page_content.
+#
+#   python benchmarks/bench_extract.py [corpus_dir] [--iterations N]
+#   python benchmarks/bench_extract.py corpus_dir --fetch https://www.drugs.com/metformin.html ...
+#
+# corpus_dir holds saved *.html pages. If it is empty, a synthetic corpus of
+# script-heavy pages between 50KB and 4MB is generated instead. The baseline
+# needs beautifulsoup4 (pip install beautifulsoup4), which the function itself
+# no longer uses.
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from html_text import extract_visible_text  # noqa: E402
+
+TEXT_LIMIT = 1500
+CHUNK_SIZE = 16 * 1024
+MAX_BYTES = 1024 * 1024
+
+
+def baseline(body: bytes) -> str:
+    soup = BeautifulSoup(body.decode('utf-8', errors='replace'), 'html.parser')
+    return soup.get_text(strip=True, separator='\n')[:TEXT_LIMIT]
+
+
+def streaming(body: bytes) -> str:
+    chunks = (body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE))
+    return extract_visible_text(chunks, limit=TEXT_LIMIT, max_bytes=MAX_BYTES)
+
+
+def synthetic_page(size: int, rng: random.Random) -> bytes:
+    words = ["metformin", "dosage", "side", "effects", "glucose", "insulin", "patients", "&amp;", "&nbsp;", "mg"]
+    parts = ["<!DOCTYPE html><html><head><title>Drug &amp; info</title>",
+             "<style>" + "body{margin:0}" * 2000 + "</style>",
+             "<script>var cfg = {" + "'k':'<p>not text</p>'," * 4000 + "};</script></head><body>",
+             "<nav><ul>" + "".join(f"<li><a href='/x{i}'>Link {i}</a></li>" for i in range(200)) + "</ul></nav>"]
+    length = sum(len(p) for p in parts)
+    while length < size:
+        paragraph = "<p>" + " ".join(rng.choice(words) for _ in range(60)) + "</p><!-- ad slot -->\n"
+        parts.append(paragraph)
+        length += len(paragraph)
+    parts.append("</body></html>")
+    return "".join(parts).encode('utf-8')
+
+
+def load_corpus(corpus_dir: str):
+    pages = []
+    if corpus_dir and os.path.isdir(corpus_dir):
+        for name in sorted(os.listdir(corpus_dir)):
+            if name.endswith('.html'):
+                with open(os.path.join(corpus_dir, name), 'rb') as f:
+                    pages.append((name, f.read()))
+    if not pages:
+        rng = random.Random(0)
+        for size in (50_000, 250_000, 1_000_000, 4_000_000):
+            pages.append((f"synthetic-{size // 1000}k.html", synthetic_page(size, rng)))
+    return pages
+
+
+def fetch_pages(corpus_dir: str, urls):
+    import requests
+    os.makedirs(corpus_dir, exist_ok=True)
+    for url in urls:
+        response = requests.get(url, timeout=30, headers={'User-Agent': 'Mozilla/5.0'})
+        name = hashlib.sha256(url.encode()).hexdigest()[:16] + '.html'
+        with open(os.path.join(corpus_dir, name), 'wb') as f:
+            f.write(response.content)
+        print(f"saved {url} -> {name} ({len(response.content)} bytes)")
+
+
+def measure(fn, body: bytes, iterations: int):
+    tracemalloc.start()
+    fn(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    start = perf_counter()
+    for _ in range(iterations):
+        fn(body)
+    return (perf_counter() - start) / iterations * 1000, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark streaming page extraction against BeautifulSoup.')
+    parser.add_argument('corpus_dir', nargs='?', default=os.path.join(os.path.dirname(__file__), 'pages'))
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--fetch', nargs='+', metavar='URL')
+    args = parser.parse_args()
+
+    if args.fetch:
+        fetch_pages(args.corpus_dir, args.fetch)
+
+    pages = load_corpus(args.corpus_dir)
+    print(f"{'page':<28}{'size':>10}{'bs4 ms':>10}{'stream ms':>11}{'bs4 peak':>11}{'stream peak':>13}  same")
+    totals = [0.0, 0.0]
+    mismatches = 0
+    for name, body in pages:
+        old_ms, old_peak = measure(baseline, body, args.iterations)
+        new_ms, new_peak = measure(streaming, body, args.iterations)
+        # Pages over MAX_BYTES can legitimately differ if their text starts late.
+        same = baseline(body) == streaming(body)
+        mismatches += not same
+        totals[0] += old_ms
+        totals[1] += new_ms
+        print(f"{name[:27]:<28}{len(body):>10}{old_ms:>10.1f}{new_ms:>11.1f}"
+              f"{old_peak // 1024:>9}KB{new_peak // 1024:>11}KB  {'yes' if same else 'NO'}")
+    print(f"total: bs4 {totals[0]:.1f} ms, streaming {totals[1]:.1f} ms "
+          f"({totals[0] / max(totals[1], 1e-9):.1f}x), {mismatches} page(s) with different output")
+
+
+if __name__ == '__main__':
+    main()
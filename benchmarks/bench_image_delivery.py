@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Payload size and serialization cost of the image delivery options.
+#
+#   python benchmarks/bench_image_delivery.py [--image render.png] [--iterations 20]
+#
+# Compares the old response (Stability's base64 PNG embedded in the JSON and
+# logged with indent=2) with inline WebP/JPEG data URIs at a few qualities and
+# with a stored-image URL. For each it reports the one-off encode time, the
+# response size, and the time to dump (body + log line) and parse the JSON.
+# Without --image a smooth 1024x1024 synthetic render is used; re-encoding
+# needs Pillow.
+
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import images  # noqa: E402
+import stubs  # noqa: E402
+
+BLOG_POST = "Lorem ipsum dolor sit amet. " * 200
+
+VARIANTS = [
+    ('legacy png (base64)', None, None, None),
+    ('inline webp q60', 'inline', 'webp', 60),
+    ('inline webp q80', 'inline', 'webp', 80),
+    ('inline jpeg q80', 'inline', 'jpeg', 80),
+    ('url (webp q80)', 'url', 'webp', 80),
+]
+
+
+def synthetic_render(size: int = 1024) -> bytes:
+    # Gradients and soft shapes compress roughly like an illustration; fall
+    # back to the stubs' noise PNG (a worst case) without Pillow.
+    Image = images.load_pillow()
+    if Image is None:
+        return stubs.png_bytes(size, size)
+    from PIL import ImageDraw, ImageFilter
+    image = Image.new('RGB', (size, size))
+    pixels = image.load()
+    for y in range(size):
+        for x in range(size):
+            pixels[x, y] = (x * 255 // size, y * 255 // size, 160)
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        offset = i * size // 14
+        draw.ellipse((offset, offset // 2, offset + size // 5, offset // 2 + size // 5),
+                     fill=(255 - i * 20, 80 + i * 10, i * 20))
+    image = image.filter(ImageFilter.GaussianBlur(3))
+    out = io.BytesIO()
+    image.save(out, format='PNG')
+    return out.getvalue()
+
+
+def timed(fn, iterations: int) -> float:
+    started = perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (perf_counter() - started) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image delivery payloads.')
+    parser.add_argument('--image', help='PNG to use instead of the synthetic render')
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, 'rb') as f:
+            png = f.read()
+    else:
+        png = synthetic_render()
+    image_b64 = base64.b64encode(png).decode('ascii')
+    # A throwaway store, created up front so it isn't part of the timings.
+    images._blob_store = images.LocalBlobStore(path=tempfile.mkdtemp(prefix='bench-images-'))
+    print(f"Source PNG: {len(png) / 1024:.1f} KB (base64 {len(image_b64) / 1024:.1f} KB)"
+          + ("" if images.load_pillow() else "; Pillow not installed, all variants are the PNG"))
+
+    print(f"{'variant':<22}{'encode ms':>10}{'body KB':>10}{'dump ms':>10}{'parse ms':>10}")
+    for label, delivery, image_format, quality in VARIANTS:
+        if delivery is None:
+            encode_ms, blog_image = 0.0, image_b64
+        else:
+            images.IMAGE_FORMAT, images.IMAGE_QUALITY = image_format, quality
+            started = perf_counter()
+            blog_image = images.deliver_image(image_b64, delivery=delivery)
+            encode_ms = (perf_counter() - started) * 1000
+        body = {'blogPost': BLOG_POST, 'blogImage': blog_image, 'imagePrompt': 'A calm clinical illustration'}
+        serialized = json.dumps(body)
+        # The old handler also logged the whole body with indent=2.
+        dump = (lambda: (json.dumps(body), json.dumps(body, indent=2))) if delivery is None else \
+            (lambda: json.dumps(body))
+        dump_ms = timed(dump, args.iterations)
+        parse_ms = timed(lambda: json.loads(serialized), args.iterations)
+        print(f"{label:<22}{encode_ms:>10.1f}{len(serialized) / 1024:>10.1f}{dump_ms:>10.2f}{parse_ms:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Offline latency/throughput benchmark for the whole pipeline and its stages.
+#
+# Runs against the stubs in benchmarks/stubs.py (started in a separate
+# process so they don't compete for our GIL) and needs no network:
+#
+#   python benchmarks/bench_pipeline.py --target handler,retrieval --concurrency 1,4,16 --requests 32 \
+#       --latency anthropic=800,stability=2000,brave=150,pages=80 --error-rate pages=0.05
+#
+# For every target and concurrency level it reports p50/p95/p99 latency,
+# throughput, errors, the process's peak RSS, and how many outbound calls were
+# retried, hedged or refused by an open circuit breaker. Caches are disabled
+# unless --cache is given, and every call uses a distinct drug name so
+# requests are not coalesced. Fault scenarios combine the stub options with a
+# per-call deadline, e.g. a slow tail of pages with and without hedging:
+#
+#   python benchmarks/bench_pipeline.py --target retrieval --stall-rate pages=0.2 --stall-ms 8000 --deadline 6
+#   DEPENDENCY_POLICIES='{"pages": {"hedgeAfter": 0}}' python benchmarks/bench_pipeline.py ...
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import stubs  # noqa: E402
+
+TARGETS = ('handler', 'stream', 'search_queries', 'search', 'page', 'retrieval', 'compare', 'blog_post', 'blog_image')
+
+
+def serve_stubs(args, port_queue):
+    server = stubs.start_stub_server(stubs.config_from_args(args))
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KB on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def make_call(lf, target: str, base_url: str):
+    details = "A once-daily oral medication used to treat type 2 diabetes."
+
+    def call(i: int):
+        drug = f"benchdrug{i}"
+        if target == 'handler':
+            result = lf.lambda_handler({'body': json.dumps({'drugName': drug, 'drugDetails': details})}, None)
+            if result['statusCode'] != 200:
+                raise Exception(f"status {result['statusCode']}")
+        elif target == 'stream':
+            for _ in lf.generate_blog_events(drug, details):
+                pass
+        elif target == 'search_queries':
+            lf.generate_search_queries(drug)
+        elif target == 'search':
+            lf.get_search_results(f"{drug} alternatives")
+        elif target == 'page':
+            lf.get_page_content(f"{base_url}/pages/{drug}")
+        elif target == 'retrieval':
+            lf.find_competitor_drugs(drug)
+        elif target == 'compare':
+            lf.compare_drugs(drug, details, "<item index=\"1\">competitor text</item>")
+        elif target == 'blog_post':
+            lf.generate_blog_post(drug, details, "comparison text")
+        elif target == 'blog_image':
+            image, _ = lf.generate_blog_image(drug, "blog text " * 200)
+            if image is None:
+                raise Exception("no image")
+    return call
+
+
+def run_level(call, concurrency: int, requests: int, offset: int, deadline: float = None):
+    from resilience import deadline_scope
+    from tracing import trace_request
+    latencies = []
+    errors = 0
+    upstream = {'retries': 0, 'hedged': 0, 'circuitOpen': 0}
+
+    def timed(i):
+        start = perf_counter()
+        with trace_request('bench') as trace, deadline_scope(deadline):
+            try:
+                call(offset + i)
+                error = None
+            except Exception as e:
+                error = e
+        return perf_counter() - start, error, trace.summary(include_spans=False)['upstream']
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency, error, calls in pool.map(timed, range(requests)):
+            latencies.append(latency * 1000)
+            errors += error is not None
+            for dependency in calls.values():
+                upstream['retries'] += dependency['attempts'] - dependency['calls']
+                upstream['hedged'] += dependency['hedged']
+                upstream['circuitOpen'] += dependency['circuitOpen']
+    wall = perf_counter() - started
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'p50Ms': round(percentile(latencies, 0.50), 1),
+        'p95Ms': round(percentile(latencies, 0.95), 1),
+        'p99Ms': round(percentile(latencies, 0.99), 1),
+        'throughput': round(requests / wall, 2),
+        'peakRssMb': peak_rss_mb(),
+        **upstream,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline offline against stub services.')
+    parser.add_argument('--target', default='handler', help=f"comma-separated, from: {', '.join(TARGETS)}")
+    parser.add_argument('--concurrency', default='1,4,16', help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=16, help='calls per concurrency level')
+    parser.add_argument('--cache', action='store_true', help='keep the pipeline caches enabled')
+    parser.add_argument('--deadline', type=float, help='deadline in seconds for each call')
+    parser.add_argument('--json', help='also write the results to this file')
+    stubs.add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    targets = [target.strip() for target in args.target.split(',') if target.strip()]
+    unknown = set(targets) - set(TARGETS)
+    if unknown:
+        parser.error(f"unknown target(s): {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    port_queue = multiprocessing.Queue()
+    stub_process = multiprocessing.Process(target=serve_stubs, args=(args, port_queue), daemon=True)
+    stub_process.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+    os.environ.update(stubs.stub_environment(base_url))
+    os.environ.setdefault('BRAVE_QPS', '1000')
+    os.environ.setdefault('BRAVE_BURST', '1000')
+    if not args.cache:
+        os.environ['CACHE_BACKEND'] = 'none'
+    import logging
+    logging.disable(logging.INFO)
+    import lambda_function as lf
+
+    results = []
+    offset = 0
+    print(f"{'target':<16}{'conc':>6}{'reqs':>6}{'errs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'req/s':>9}{'rss MB':>9}{'retry':>7}{'hedge':>7}{'open':>6}")
+    for target in targets:
+        call = make_call(lf, target, base_url)
+        for concurrency in levels:
+            # The pipeline prints progress to stdout; keep the table readable.
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = run_level(call, concurrency, args.requests, offset, args.deadline)
+            offset += args.requests
+            results.append({'target': target, **result})
+            print(f"{target:<16}{concurrency:>6}{result['requests']:>6}{result['errors']:>6}{result['p50Ms']:>10}"
+                  f"{result['p95Ms']:>10}{result['p99Ms']:>10}{result['throughput']:>9}{result['peakRssMb']:>9}"
+                  f"{result['retries']:>7}{result['hedged']:>7}{result['circuitOpen']:>6}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    stub_process.terminate()
+
+
+if __name__ == '__main__':
+    main()
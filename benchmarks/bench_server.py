@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# Load test for the long-lived server (asgi.py, or server.py for comparison).
+#
+#   python benchmarks/bench_server.py --concurrency 1,8,32,64 --duration 20 \
+#       --workers 1 --server-concurrency 8 --queue-size 16 --latency anthropic=800,stability=2000
+#
+# Starts the stubs and the server (pointed at the stubs) in child processes,
+# then for each concurrency level runs that many closed-loop clients against
+# POST /generate for --duration seconds. It reports completed requests/s,
+# p50/p95/p99 latency of the successful ones, how many were shed with 503 and
+# any other errors. Caches are disabled unless --cache is given, and every
+# request uses a distinct drug name. --url targets an already running server
+# instead (the stub options then don't apply).
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter, sleep
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import stubs  # noqa: E402
+from bench_pipeline import percentile, serve_stubs  # noqa: E402
+
+DETAILS = "A once-daily oral medication used to treat type 2 diabetes."
+
+
+def start_server(args, base_url: str, port: int):
+    env = {**os.environ, **stubs.stub_environment(base_url), 'BRAVE_QPS': '1000', 'BRAVE_BURST': '1000'}
+    if not args.cache:
+        env['CACHE_BACKEND'] = 'none'
+    if args.server == 'asgi':
+        command = [sys.executable, 'asgi.py', '--port', str(port), '--workers', str(args.workers),
+                   '--concurrency', str(args.server_concurrency), '--queue-size', str(args.queue_size),
+                   '--queue-timeout', str(args.queue_timeout)]
+    else:
+        command = [sys.executable, 'server.py', '--port', str(port)]
+    process = subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    started = monotonic()
+    while monotonic() - started < 60:
+        try:
+            requests.options(f"{url}/generate", timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                raise SystemExit(f"{args.server} server exited with status {process.returncode}")
+            sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"{args.server} server did not start within 60s")
+
+
+def run_level(url: str, concurrency: int, duration: float, offset: int):
+    latencies = []
+    counts = {'ok': 0, 'shed': 0, 'errors': 0}
+    lock = threading.Lock()
+    stop_at = monotonic() + duration
+    counter = itertools.count(offset)
+
+    def client():
+        session = requests.Session()
+        while monotonic() < stop_at:
+            with lock:
+                i = next(counter)
+            body = {'drugName': f"loaddrug{i}", 'drugDetails': DETAILS}
+            start = perf_counter()
+            try:
+                response = session.post(f"{url}/generate", json=body, timeout=600)
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+            elapsed = (perf_counter() - start) * 1000
+            with lock:
+                if status == 200:
+                    counts['ok'] += 1
+                    latencies.append(elapsed)
+                elif status == 503:
+                    counts['shed'] += 1
+                else:
+                    counts['errors'] += 1
+            if status == 503:
+                # Honour the shedding: back off instead of retrying at once.
+                sleep(float(response.headers.get('Retry-After', '1')) / 10)
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    wall = perf_counter() - started
+    return {
+        'concurrency': concurrency,
+        **counts,
+        'throughput': round(counts['ok'] / wall, 2),
+        'p50Ms': round(percentile(latencies, 0.50), 1),
+        'p95Ms': round(percentile(latencies, 0.95), 1),
+        'p99Ms': round(percentile(latencies, 0.99), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the HTTP server against stub services.')
+    parser.add_argument('--url', help='an already running server to test')
+    parser.add_argument('--server', choices=('asgi', 'threading'), default='asgi', help='server to start')
+    parser.add_argument('--port', type=int, default=8181)
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per concurrency level')
+    parser.add_argument('--workers', type=int, default=1, help='asgi worker processes')
+    parser.add_argument('--server-concurrency', type=int, default=8, help='pipeline threads per asgi worker')
+    parser.add_argument('--queue-size', type=int, default=16, help='asgi requests waiting per worker')
+    parser.add_argument('--queue-timeout', type=float, default=30)
+    parser.add_argument('--cache', action='store_true', help='keep the pipeline caches enabled')
+    parser.add_argument('--json', help='also write the results to this file')
+    stubs.add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    stub_process = server_process = None
+    url = args.url
+    if url is None:
+        port_queue = multiprocessing.Queue()
+        stub_process = multiprocessing.Process(target=serve_stubs, args=(args, port_queue), daemon=True)
+        stub_process.start()
+        server_process, url = start_server(args, f"http://127.0.0.1:{port_queue.get(timeout=30)}", args.port)
+
+    results = []
+    offset = 0
+    print(f"{'conc':>6}{'ok':>7}{'shed':>7}{'errs':>7}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    try:
+        for concurrency in (int(level) for level in args.concurrency.split(',')):
+            result = run_level(url, concurrency, args.duration, offset)
+            offset += result['ok'] + result['shed'] + result['errors']
+            results.append(result)
+            print(f"{concurrency:>6}{result['ok']:>7}{result['shed']:>7}{result['errors']:>7}{result['throughput']:>9}"
+                  f"{result['p50Ms']:>10}{result['p95Ms']:>10}{result['p99Ms']:>10}")
+        try:
+            health = requests.get(f"{url}/healthz", timeout=5)
+            if health.ok:
+                print(f"Server: {json.dumps(health.json())}")
+        except requests.RequestException:
+            pass
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait(timeout=30)
+        if stub_process is not None:
+            stub_process.terminate()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# Local stand-ins for every upstream the pipeline talks to, on one port:
+#
+#   /brave/res/v1/web/search        Brave web search
+#   /anthropic/v1/messages          Anthropic Messages API (plain and streamed)
+#   /stability/v1/generation/...    Stability text-to-image
+#   /pages/<id>                     the result pages Brave links to
+#
+# Responses are replayed from a cassette directory; anything not recorded is
+# synthesized, so the stubs work with an empty cassette. With --record, cache
+# misses are forwarded to the real services (using the real API keys from the
+# environment) and saved. Stability images are always synthesized.
+#
+# Every service can be given an injected latency and error rate, and a share
+# of responses that stall (a slow tail, for deadlines and hedged requests):
+#
+#   python benchmarks/stubs.py --port 8900 --latency anthropic=1500,stability=3000 --error-rate brave=0.05 \
+#       --stall-rate pages=0.1 --stall-ms 8000
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, quote, urlparse
+
+import requests
+
+DEFAULT_CASSETTE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SERVICES = ('brave', 'anthropic', 'stability', 'pages')
+REAL_HOSTS = {
+    'brave': 'https://api.search.brave.com',
+    'anthropic': 'https://api.anthropic.com',
+}
+
+
+def parse_service_map(value: str, cast=float):
+    result = {}
+    for item in (value or '').split(','):
+        name, _, number = item.strip().partition('=')
+        if name and number:
+            if name not in SERVICES:
+                raise ValueError(f"Unknown service: {name}")
+            result[name] = cast(number)
+    return result
+
+
+def digest(value: str) -> str:
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
+
+
+def png_bytes(width: int, height: int, seed: int = 0) -> bytes:
+    # Incompressible noise, so the payload is about the size of a real render.
+    rng = random.Random(seed)
+    rows = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows, 1)) + chunk(b'IEND', b'')
+
+
+class Cassette:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+        for service in ('brave', 'anthropic', 'pages'):
+            file_path = os.path.join(path, f"{service}.json")
+            if os.path.exists(file_path):
+                with open(file_path) as f:
+                    self.data[service] = json.load(f)
+            else:
+                self.data[service] = {}
+
+    def get(self, service: str, key: str):
+        with self.lock:
+            return self.data[service].get(key)
+
+    def put(self, service: str, key: str, value, persist: bool = True):
+        with self.lock:
+            self.data[service][key] = value
+            if not persist:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, f"{service}.json"), 'w') as f:
+                json.dump(self.data[service], f, indent=1, sort_keys=True)
+
+
+class StubConfig:
+    def __init__(self, cassette: Cassette, latency=None, error_rate=None, record: bool = False, seed: int = 0,
+                 image_size: int = 512, stall_rate=None, stall_ms: float = 5000):
+        self.cassette = cassette
+        self.latency = latency or {}
+        self.error_rate = error_rate or {}
+        self.stall_rate = stall_rate or {}
+        self.stall_ms = stall_ms
+        self.record = record
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.image_b64 = base64.b64encode(png_bytes(image_size, image_size, seed)).decode('ascii')
+        self.requests = {service: 0 for service in SERVICES}
+
+    def random(self) -> float:
+        with self.rng_lock:
+            return self.rng.random()
+
+    def delay(self, service: str):
+        # Latency is the mean in milliseconds, with +/-25% uniform jitter.
+        mean = self.latency.get(service, 0)
+        if mean:
+            sleep(mean * (0.75 + 0.5 * self.random()) / 1000)
+        if self.random() < self.stall_rate.get(service, 0):
+            sleep(self.stall_ms / 1000)
+
+    def should_fail(self, service: str) -> bool:
+        return self.random() < self.error_rate.get(service, 0)
+
+
+def synthetic_page(title: str, paragraphs: int = 40) -> str:
+    body = ''.join(
+        f"<p>{title} paragraph {i}: dosage, efficacy and side effect notes for comparison.</p>"
+        for i in range(paragraphs)
+    )
+    return (f"<html><head><title>{title}</title><script>var tracking = {{}};</script>"
+            f"<style>body {{ margin: 0 }}</style></head><body><nav>Home | Drugs | Conditions</nav>{body}</body></html>")
+
+
+def synthetic_completion(prompt: str, max_tokens: int) -> str:
+    if 'search queries' in prompt:
+        name = prompt.split('Drug name:')[-1].split('\n')[0].strip() or 'drug'
+        return json.dumps([f"{name} alternatives", f"drugs similar to {name}", f"{name} competitors"])
+    words = min(max_tokens, 400)
+    if words <= 100:
+        return ' '.join(f"word{i % 50}" for i in range(words))
+    # Longer completions are shaped like a blog post: markdown sections.
+    sections = [f"# Title\n\n" + ' '.join(f"word{i % 50}" for i in range(40))]
+    for section in range(1, words // 80 + 1):
+        sections.append(f"## Section {section}\n\n" + ' '.join(f"word{i % 50}" for i in range(80)))
+    return '\n\n'.join(sections)
+
+
+def make_handler(config: StubConfig):
+    cassette = config.cassette
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status: int, body: bytes, content_type: str = 'application/json', headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, status: int, payload, headers=None):
+            self.send_body(status, json.dumps(payload).encode('utf-8'), headers=headers)
+
+        def base_url(self) -> str:
+            return f"http://{self.headers.get('Host')}"
+
+        def begin(self, service: str) -> bool:
+            with config.rng_lock:
+                config.requests[service] += 1
+            config.delay(service)
+            if config.should_fail(service):
+                if service == 'brave':
+                    self.send_json(429, {'error': 'injected rate limit'}, headers={'Retry-After': '0'})
+                elif service == 'anthropic':
+                    self.send_json(529, {'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'injected'}})
+                else:
+                    self.send_json(500, {'error': 'injected failure'})
+                return False
+            return True
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path == '/brave/res/v1/web/search':
+                if self.begin('brave'):
+                    self.brave(parse_qs(parsed.query))
+            elif parsed.path.startswith('/pages/'):
+                if self.begin('pages'):
+                    self.page(parsed.path[len('/pages/'):])
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            if self.path == '/anthropic/v1/messages':
+                if self.begin('anthropic'):
+                    self.anthropic(payload)
+            elif self.path.startswith('/stability/v1/generation/'):
+                if self.begin('stability'):
+                    samples = int(payload.get('samples', 1))
+                    self.send_json(200, {'artifacts': [
+                        {'base64': config.image_b64, 'seed': payload.get('seed', 0), 'finishReason': 'SUCCESS'}
+                        for _ in range(samples)
+                    ]})
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def brave(self, params):
+            query = params.get('q', [''])[0]
+            key = ' '.join(query.lower().split())
+            recorded = cassette.get('brave', key)
+            if recorded is None and config.record:
+                response = requests.get(
+                    f"{REAL_HOSTS['brave']}/res/v1/web/search",
+                    params={'q': query, 'count': params.get('count', ['5'])[0]},
+                    headers={'Accept': 'application/json', 'X-Subscription-Token': os.environ['BRAVE_API_KEY']},
+                    timeout=60
+                )
+                response.raise_for_status()
+                recorded = response.json()
+                cassette.put('brave', key, recorded)
+            if recorded is None:
+                recorded = {'web': {'results': [
+                    {'url': f"https://example.org/{quote(key)}/{i}", 'title': f"{query} result {i}",
+                     'description': f"About {query}"}
+                    for i in range(int(params.get('count', ['5'])[0]))
+                ]}}
+            # Point result URLs at /pages so page fetches are stubbed too.
+            results = []
+            for result in recorded.get('web', {}).get('results', []):
+                page_id = digest(result['url'])
+                if cassette.get('pages', page_id) is None:
+                    cassette.put('pages', page_id, {'url': result['url'], 'html': None}, persist=config.record)
+                results.append({**result, 'url': f"{self.base_url()}/pages/{page_id}"})
+            self.send_json(200, {**recorded, 'web': {**recorded.get('web', {}), 'results': results}})
+
+        def page(self, page_id: str):
+            recorded = cassette.get('pages', page_id) or {'url': page_id, 'html': None}
+            html = recorded.get('html')
+            if html is None and config.record and recorded['url'].startswith('http'):
+                try:
+                    html = requests.get(recorded['url'], timeout=10, headers={'User-Agent': 'Mozilla/5.0'}).text
+                    cassette.put('pages', page_id, {'url': recorded['url'], 'html': html})
+                except requests.RequestException:
+                    html = None
+            if html is None:
+                html = synthetic_page(recorded['url'])
+            self.send_body(200, html.encode('utf-8'), content_type='text/html; charset=utf-8')
+
+        def anthropic(self, payload):
+            prompt = payload['messages'][-1]['content']
+            key = digest(json.dumps([payload.get('system'), prompt, payload.get('max_tokens')]))
+            recorded = cassette.get('anthropic', key)
+            if recorded is None and config.record:
+                response = requests.post(
+                    f"{REAL_HOSTS['anthropic']}/v1/messages",
+                    json={**payload, 'stream': False},
+                    headers={'x-api-key': os.environ['ANTHROPIC_API_KEY'], 'anthropic-version': '2023-06-01'},
+                    timeout=600
+                )
+                response.raise_for_status()
+                message = response.json()
+                recorded = {
+                    'text': ''.join(block.get('text', '') for block in message['content']),
+                    'usage': message['usage'],
+                }
+                cassette.put('anthropic', key, recorded)
+            if recorded is None:
+                text = synthetic_completion(prompt, payload.get('max_tokens', 1024))
+                recorded = {'text': text, 'usage': {'input_tokens': len(prompt) // 4, 'output_tokens': len(text) // 4}}
+            if payload.get('stream'):
+                self.anthropic_stream(payload, recorded)
+                return
+            self.send_json(200, {
+                'id': f"msg_{key}",
+                'type': 'message',
+                'role': 'assistant',
+                'model': payload.get('model'),
+                'content': [{'type': 'text', 'text': recorded['text']}],
+                'stop_reason': 'end_turn',
+                'stop_sequence': None,
+                'usage': recorded['usage'],
+            })
+
+        def anthropic_stream(self, payload, recorded):
+            text = recorded['text']
+            pieces = [text[i:i + 16] for i in range(0, len(text), 16)] or ['']
+            events = [('message_start', {'type': 'message_start', 'message': {
+                'id': 'msg_stub', 'type': 'message', 'role': 'assistant', 'model': payload.get('model'),
+                'content': [], 'stop_reason': None, 'stop_sequence': None,
+                'usage': {'input_tokens': recorded['usage']['input_tokens'], 'output_tokens': 0}}}),
+                ('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                         'content_block': {'type': 'text', 'text': ''}})]
+            events += [('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                                'delta': {'type': 'text_delta', 'text': piece}}) for piece in pieces]
+            events += [('content_block_stop', {'type': 'content_block_stop', 'index': 0}),
+                       ('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn',
+                                                                             'stop_sequence': None},
+                                          'usage': {'output_tokens': recorded['usage']['output_tokens']}}),
+                       ('message_stop', {'type': 'message_stop'})]
+            # Spread the injected latency over the tokens, like a real stream.
+            per_piece = config.latency.get('anthropic_token', 0) / 1000
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for name, data in events:
+                chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+                self.wfile.write(f"{len(chunk):X}\r\n".encode('ascii') + chunk + b"\r\n")
+                self.wfile.flush()
+                if name == 'content_block_delta' and per_piece:
+                    sleep(per_piece)
+            self.wfile.write(b"0\r\n\r\n")
+
+    return StubHandler
+
+
+def start_stub_server(config: StubConfig, host: str = '127.0.0.1', port: int = 0):
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stub_environment(base_url: str):
+    # Environment that points lambda_function at the stubs.
+    return {
+        'BRAVE_SEARCH_URL': f"{base_url}/brave/res/v1/web/search",
+        'ANTHROPIC_BASE_URL': f"{base_url}/anthropic",
+        'STABILITY_API_HOST': f"{base_url}/stability",
+        'ANTHROPIC_API_KEY': os.environ.get('ANTHROPIC_API_KEY', 'stub'),
+        'BRAVE_API_KEY': os.environ.get('BRAVE_API_KEY', 'stub'),
+        'STABILITY_API_KEY': os.environ.get('STABILITY_API_KEY', 'stub'),
+    }
+
+
+def add_stub_arguments(parser):
+    parser.add_argument('--cassette', default=DEFAULT_CASSETTE, help='directory of recorded interactions')
+    parser.add_argument('--record', action='store_true', help='forward cassette misses to the real services')
+    parser.add_argument('--latency', default='', help='mean injected latency in ms, e.g. anthropic=1500,brave=200')
+    parser.add_argument('--token-latency', type=float, default=0, help='ms between streamed Anthropic deltas')
+    parser.add_argument('--error-rate', default='', help='injected error rate, e.g. brave=0.05,pages=0.1')
+    parser.add_argument('--stall-rate', default='', help='share of responses that stall, e.g. pages=0.1')
+    parser.add_argument('--stall-ms', type=float, default=5000, help='how long a stalled response waits')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--image-size', type=int, default=512, help='edge of the synthesized PNG')
+
+
+def config_from_args(args) -> StubConfig:
+    latency = parse_service_map(args.latency)
+    if args.token_latency:
+        latency['anthropic_token'] = args.token_latency
+    return StubConfig(
+        Cassette(args.cassette),
+        latency=latency,
+        error_rate=parse_service_map(args.error_rate),
+        record=args.record,
+        seed=args.seed,
+        image_size=args.image_size,
+        stall_rate=parse_service_map(args.stall_rate),
+        stall_ms=args.stall_ms
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run stub upstream services for offline benchmarks.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_stub_server(config_from_args(args), args.host, args.port)
+    base_url = f"http://{args.host}:{server.server_port}"
+    print(f"Stubs listening on {base_url}; point the pipeline at them with:")
+    for name, value in stub_environment(base_url).items():
+        if not name.endswith('_API_KEY'):
+            print(f"  export {name}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import time
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite')
+# /tmp is the only writable path on Lambda and survives warm invocations. It
+# is 512MB by default, so the byte caps of the caches kept there (see
+# lambda_function.py) add up to well under that.
+CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/medblog-cache')
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().replace('"', ' ').replace("'", ' ').split())
+
+
+def entry_size(value) -> int:
+    return len(json.dumps(value))
+
+
+# Shared hit/miss bookkeeping for every backend.
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        # Reads and writes that failed and were skipped (full disk, locked or
+        # corrupt database).
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def as_dict(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': round(self.hits / total, 3) if total else 0.0,
+            'errors': self.errors,
+        }
+
+
+class NullCache:
+    def __init__(self, name: str = 'null', **kwargs):
+        self.name = name
+        self.stats = CacheStats()
+
+    def get(self, key: str, default=None):
+        self.stats.record(False)
+        return default
+
+    def set(self, key: str, value, ttl: float = None):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    def clear(self):
+        pass
+
+
+# In-process LRU with per-entry expiry; values are kept as-is. `max_bytes`
+# (0 = unlimited) is measured on the JSON encoding of each value.
+class MemoryCache:
+    def __init__(self, name: str = 'memory', max_entries: int = 1024, ttl: float = 3600, max_bytes: int = 0):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.stats.record(False)
+                return default
+            self.entries.move_to_end(key)
+        self.stats.record(True)
+        return entry[0]
+
+    def set(self, key: str, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time() + ttl if ttl else None
+        size = entry_size(value) if self.max_bytes else 0
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (value, expires_at, size)
+            self.total_bytes += size
+            while self.entries and (
+                len(self.entries) > self.max_entries
+                or (self.max_bytes and self.total_bytes > self.max_bytes)
+            ):
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def delete(self, key: str):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+# SQLite-backed LRU; values must be JSON-serializable. One file per cache name.
+# The cache is best-effort: a database error on get is a miss and on set is
+# skipped, both logged and counted in stats, so a full /tmp never fails a request.
+class SQLiteCache:
+    def __init__(self, name: str = 'cache', max_entries: int = 10000, ttl: float = 86400, max_bytes: int = 0,
+                 path: str = None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path or os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL,"
+            " size INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+
+    def get(self, key: str, default=None):
+        now = time()
+        try:
+            with self.lock:
+                row = self.conn.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[1] is not None and row[1] <= now:
+                    self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    row = None
+                if row is not None:
+                    self.conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        except (sqlite3.Error, OSError) as e:
+            self.failed('read', e)
+            row = None
+        if row is None:
+            self.stats.record(False)
+            return default
+        self.stats.record(True)
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time()
+        expires_at = now + ttl if ttl else None
+        payload = json.dumps(value)
+        try:
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, expires_at, accessed_at, size) VALUES (?, ?, ?, ?, ?)",
+                    (key, payload, expires_at, now, len(payload))
+                )
+                self._evict(now)
+        except (sqlite3.Error, OSError) as e:
+            self.failed('write', e)
+
+    def failed(self, operation: str, error: Exception):
+        self.stats.record_error()
+        print(f"Cache {self.name}: {operation} skipped: {str(error)}")
+
+    def _evict(self, now: float):
+        self.conn.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        count = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        if self.max_bytes:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            while total > self.max_bytes:
+                row = self.conn.execute("SELECT key, size FROM entries ORDER BY accessed_at LIMIT 1").fetchone()
+                if row is None:
+                    break
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (row[0],))
+                total -= row[1]
+
+    def delete(self, key: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM entries")
+
+
+# Collapses concurrent calls for the same key into one: the first caller runs
+# `fn`, everyone arriving while it is in flight waits for and shares its result.
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: str, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+BACKENDS = {
+    'none': NullCache,
+    'memory': MemoryCache,
+    'sqlite': SQLiteCache,
+}
+
+
+def make_cache(name: str, backend: str = None, **kwargs):
+    backend = (backend or CACHE_BACKEND).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown cache backend: {backend}")
+    try:
+        return BACKENDS[backend](name=name, **kwargs)
+    except (OSError, sqlite3.Error) as e:
+        # A read-only filesystem shouldn't take the function down with it.
+        print(f"Falling back to in-memory cache for {name}: {str(e)}")
+        kwargs.pop('path', None)
+        return MemoryCache(name=name, **kwargs)
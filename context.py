@@ -0,0 +1,106 @@
+import re
+
+# Builds prompt context from retrieved text within a token budget: navigation
+# and other boilerplate lines are dropped, sentences repeated across sources
+# are kept once, and the sentences most relevant to the drug are selected
+# (in their original order) until the budget is spent. Token counts are
+# estimated at ~4 characters per token, which is close enough for budgeting
+# and needs no tokenizer or API call.
+CHARS_PER_TOKEN = 4
+
+BOILERPLATE_PATTERNS = re.compile(
+    r'\b(cookies?|subscribe|newsletters?|sign (in|up)|log ?in|privacy policy|terms of (use|service)|'
+    r'all rights reserved|copyright|advertisement|skip to (main )?content|share on|follow us|'
+    r'javascript|your browser|accept all|read more|related articles|back to top)\b|©',
+    re.IGNORECASE
+)
+# Lines are judged whole: a short line naming one of the patterns is a banner
+# or footer, while a longer one is content that happens to mention it.
+BOILERPLATE_MAX_WORDS = 20
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9"(])')
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+# Words that mark the facts a comparison is built from.
+EVIDENCE_TERMS = {
+    'effective', 'effectiveness', 'efficacy', 'side', 'effects', 'adverse', 'risk', 'risks', 'cost', 'price',
+    'dose', 'dosage', 'approved', 'indicated', 'treatment', 'treat', 'compared', 'versus', 'vs', 'alternative',
+    'alternatives', 'study', 'studies', 'trial', 'trials', 'percent', 'reduce', 'reduces', 'works', 'mechanism',
+}
+MIN_LINE_WORDS = 5
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def words(text: str):
+    return WORD_PATTERN.findall(text.lower())
+
+
+def is_fragment(line: str) -> bool:
+    # Page text comes one text node per line: menus, buttons and breadcrumbs
+    # are short fragments without sentence punctuation.
+    return len(words(line)) < MIN_LINE_WORDS and not line.rstrip().endswith(('.', '!', '?', ':'))
+
+
+def is_boilerplate(line: str) -> bool:
+    return len(words(line)) <= BOILERPLATE_MAX_WORDS and BOILERPLATE_PATTERNS.search(line) is not None
+
+
+def split_sentences(text: str):
+    sentences = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line or is_fragment(line) or is_boilerplate(line):
+            continue
+        for sentence in SENTENCE_END.split(line):
+            sentence = sentence.strip()
+            if sentence:
+                sentences.append(sentence)
+    return sentences
+
+
+def score_sentence(sentence: str, focus_words, position: int) -> float:
+    sentence_words = set(words(sentence))
+    score = 2.0 * len(focus_words & sentence_words) + 1.0 * len(EVIDENCE_TERMS & sentence_words)
+    if any(char.isdigit() for char in sentence):
+        score += 0.5  # doses, percentages, trial results
+    # Earlier sentences tend to be the summary of a page or post.
+    return score + 1.0 / (1 + position)
+
+
+def build_context(sources, focus: str, budget_tokens: int):
+    # sources: list of texts (one per page or document). Returns the condensed
+    # texts, in the same order, and a report of tokens before and after.
+    focus_words = set(words(focus))
+    seen = set()
+    candidates = []
+    for source_index, text in enumerate(sources):
+        for position, sentence in enumerate(split_sentences(text)):
+            key = ' '.join(words(sentence))
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            candidates.append({
+                'source': source_index,
+                'order': len(candidates),
+                'text': sentence,
+                'tokens': estimate_tokens(sentence) + 1,
+                'score': score_sentence(sentence, focus_words, position),
+            })
+
+    chosen = []
+    used = 0
+    for candidate in sorted(candidates, key=lambda candidate: candidate['score'], reverse=True):
+        if used + candidate['tokens'] > budget_tokens:
+            continue
+        chosen.append(candidate)
+        used += candidate['tokens']
+
+    condensed = []
+    for source_index in range(len(sources)):
+        kept = sorted((c for c in chosen if c['source'] == source_index), key=lambda c: c['order'])
+        condensed.append(' '.join(c['text'] for c in kept))
+
+    before = sum(estimate_tokens(text) for text in sources)
+    after = sum(estimate_tokens(text) for text in condensed)
+    return condensed, {'tokensBefore': before, 'tokensAfter': after, 'tokensSaved': max(0, before - after)}
@@ -11,6 +11,40 @@ const api = axios.create({
   }
 });
 
+// When set, the blog is read from the local server's NDJSON event stream and
+// rendered as it is written instead of after the whole pipeline finishes.
+const STREAM_URL = process.env.REACT_APP_STREAM_URL;
+
+// Root of the API that returned the blog: the local server's origin, or the
+// API Gateway stage (https://.../prod/), which a bare '/' would drop.
+const API_ROOT = STREAM_URL ? new URL('/', STREAM_URL).href : new URL('.', api.defaults.baseURL).href;
+
+// blogImage is a data URI or a URL; relative URLs are served by the API that
+// returned them, under its root. Older deployments sent bare base64 PNG.
+const imageSource = (blogImage) => {
+  if (/^(data:|https?:)/.test(blogImage)) return blogImage;
+  if (blogImage.startsWith('/')) return new URL(blogImage.slice(1), API_ROOT).href;
+  return `data:image/png;base64,${blogImage}`;
+};
+
+const readEventStream = async (response, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+    lines.filter(line => line.trim()).forEach(line => onEvent(JSON.parse(line)));
+  }
+  if (buffer.trim()) {
+    onEvent(JSON.parse(buffer));
+  }
+};
+
 function App() {
   const [drugName, setDrugName] = useState('');
   const [drugDetails, setDrugDetails] = useState('');
@@ -87,6 +121,38 @@ function App() {
     };
   }, []);
 
+  const streamBlogPost = async () => {
+    const response = await fetch(STREAM_URL, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ drugName, drugDetails })
+    });
+    if (!response.ok) {
+      const data = await response.json().catch(() => ({}));
+      throw new Error(data.error || `Request failed with status ${response.status}`);
+    }
+
+    await readEventStream(response, (event) => {
+      switch (event.event) {
+        case 'blog_delta':
+          setBlogPost(prev => prev + event.text);
+          break;
+        case 'blog':
+          setBlogPost(event.blogPost);
+          break;
+        case 'image':
+          if (event.blogImage) {
+            setBlogImage(event.blogImage);
+          }
+          break;
+        case 'error':
+          throw new Error(event.error);
+        default:
+          break;
+      }
+    });
+  };
+
   const handleSubmit = async (e) => {
     e.preventDefault();
     setLoading(true);
@@ -96,6 +162,11 @@ function App() {
     setShowForm(false);
 
     try {
+      if (STREAM_URL) {
+        await streamBlogPost();
+        return;
+      }
+
       const response = await api.post('/', { drugName, drugDetails });
       
       if (response.data && response.data.blogPost) {
@@ -215,7 +286,7 @@ function App() {
                   animate={{ opacity: 1 }}
                   transition={{ duration: 0.5, delay: 0.2 }}
                 >
-                  <img src={`data:image/png;base64,${blogImage}`} alt="Blog post illustration" />
+                  <img src={imageSource(blogImage)} alt="Blog post illustration" />
                 </motion.div>   
               )}
               <motion.button
@@ -0,0 +1,99 @@
+import codecs
+from html.parser import HTMLParser
+
+# Strings under these tags are not "text" to BeautifulSoup's get_text() either.
+SKIP_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+
+
+class StopExtraction(Exception):
+    pass
+
+
+# Incremental version of BeautifulSoup(html).get_text(strip=True, separator='\n'):
+# each text node is stripped, empty ones dropped, and the rest joined with
+# newlines. Parsing stops as soon as `limit` characters have been collected.
+class VisibleTextParser(HTMLParser):
+    def __init__(self, limit: int):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.pieces = []
+        self.length = 0
+        self.pending = []
+        self.skip_depth = 0
+        self.done = False
+
+    def flush(self):
+        if not self.pending:
+            return
+        text = ''.join(self.pending).strip()
+        self.pending = []
+        if not text:
+            return
+        self.length += len(text) + (1 if self.pieces else 0)
+        self.pieces.append(text)
+        if self.length >= self.limit:
+            self.done = True
+            raise StopExtraction()
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.flush()
+
+    def handle_endtag(self, tag):
+        self.flush()
+        if tag in SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.pending.append(data)
+
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_decl(self, decl):
+        self.flush()
+
+    def handle_pi(self, data):
+        self.flush()
+
+    def feed(self, data):
+        if self.done:
+            return
+        try:
+            super().feed(data)
+        except StopExtraction:
+            pass
+
+    def text(self) -> str:
+        if not self.done:
+            try:
+                self.close()
+                self.flush()
+            except StopExtraction:
+                pass
+        return '\n'.join(self.pieces)[:self.limit]
+
+
+def extract_visible_text(chunks, limit: int = 1500, max_bytes: int = 1024 * 1024, encoding: str = None) -> str:
+    try:
+        decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    parser = VisibleTextParser(limit)
+    consumed = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = chunk[:max_bytes - consumed]
+        consumed += len(chunk)
+        parser.feed(decoder.decode(chunk))
+        if parser.done or consumed >= max_bytes:
+            break
+    else:
+        parser.feed(decoder.decode(b'', final=True))
+    return parser.text()
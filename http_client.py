@@ -0,0 +1,88 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# One pooled session for every outbound HTTP call. It lives at module level so
+# keep-alive connections (and their TLS sessions) survive warm invocations.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '60'))
+# Retries are made by resilience.call, with backoff and within the request
+# deadline; HTTP_RETRIES adds transport-level retries underneath it.
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '0'))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', '0.5'))
+# Number of distinct hosts kept pooled, and connections kept per host.
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', '32'))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '4'))
+# Per-host overrides, e.g. "api.search.brave.com=4,api.stability.ai=2".
+HTTP_HOST_POOL_SIZES = os.environ.get('HTTP_HOST_POOL_SIZES', 'api.search.brave.com=4,api.stability.ai=4')
+
+
+def parse_pool_sizes(value: str):
+    sizes = {}
+    for item in value.split(','):
+        host, _, size = item.strip().partition('=')
+        if host and size:
+            sizes[host.strip().lower()] = int(size)
+    return sizes
+
+
+def make_retry():
+    # Only idempotent requests are retried on read errors or 5xx; connection
+    # failures are retried for every method since nothing reached the server.
+    # 429 is left to the callers, which know their own rate limits.
+    return Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({'GET', 'HEAD', 'OPTIONS'}),
+        raise_on_status=False,
+        respect_retry_after_header=True
+    )
+
+
+class PooledSession(requests.Session):
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+
+def build_session():
+    session = PooledSession()
+    default_adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=make_retry()
+    )
+    session.mount('https://', default_adapter)
+    session.mount('http://', default_adapter)
+    for host, size in parse_pool_sizes(HTTP_HOST_POOL_SIZES).items():
+        session.mount(f'https://{host}/', HTTPAdapter(pool_connections=1, pool_maxsize=size, max_retries=make_retry()))
+    return session
+
+
+http_session = build_session()
+
+
+def pool_stats():
+    hosts = {}
+    adapters = {id(adapter): adapter for adapter in http_session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts[pool.host] = {
+                'requests': pool.num_requests,
+                'connections': pool.num_connections,
+            }
+    requests_made = sum(host['requests'] for host in hosts.values())
+    connections = sum(host['connections'] for host in hosts.values())
+    return {
+        'requests': requests_made,
+        'connections': connections,
+        'reused': max(0, requests_made - connections),
+        'hosts': hosts,
+    }
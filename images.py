@@ -0,0 +1,269 @@
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+
+from jobs import is_local_path
+
+logger = logging.getLogger()
+
+# Image delivery. Stability returns a base64 PNG of well over a megabyte; it is
+# decoded once, re-encoded to IMAGE_FORMAT at IMAGE_QUALITY for each width in
+# IMAGE_SIZES, and then either inlined as a data URI (IMAGE_DELIVERY=inline)
+# or written to a blob store and returned as a URL (IMAGE_DELIVERY=url). Either
+# way the result can be used directly as an <img src>. Re-encoding needs
+# Pillow (in requirements.txt); without it the PNG is passed through as is.
+#
+# Inline stays the default: url delivery needs a store every Lambda execution
+# environment can read (s3, or a local store on a shared mount) and an /images
+# route on the API. On Lambda, url delivery with a store under /tmp falls back
+# to inline, since the environment that answers GET /images is rarely the one
+# that wrote the image.
+IMAGE_DELIVERY = os.environ.get('IMAGE_DELIVERY', 'inline')
+IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'webp').lower()
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', '80'))
+# The first width is the one returned; the others are stored alongside it as
+# <key>-<width>w.<ext> (url delivery only). 0 keeps the original size.
+IMAGE_SIZES = [int(size) for size in os.environ.get('IMAGE_SIZES', '0').split(',') if size.strip()]
+IMAGE_STORE = os.environ.get('IMAGE_STORE', 'local')
+IMAGE_STORE_PATH = os.environ.get('IMAGE_STORE_PATH', '/tmp/medblog-images')
+# The local store drops its least recently used images beyond this size.
+IMAGE_STORE_MAX_BYTES = int(os.environ.get('IMAGE_STORE_MAX_BYTES', str(64 * 1024 * 1024)))
+IMAGE_STORE_BUCKET = os.environ.get('IMAGE_STORE_BUCKET', '')
+IMAGE_STORE_PREFIX = os.environ.get('IMAGE_STORE_PREFIX', 'images/')
+# Public URL the stored images are served under, e.g. a CloudFront domain or
+# this service's /images route. S3 without one hands out presigned URLs. The
+# default is relative to the API root (the API Gateway stage, or the server's
+# origin), and the frontend resolves it there.
+IMAGE_BASE_URL = os.environ.get('IMAGE_BASE_URL', '/images')
+IMAGE_URL_TTL = int(os.environ.get('IMAGE_URL_TTL', '86400'))
+
+DELIVERY_MODES = ('inline', 'url')
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+CONTENT_TYPES = {f".{name}": content_type for name, (_, content_type) in FORMATS.items()}
+ON_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+_pillow_warned = False
+
+
+def load_pillow():
+    global _pillow_warned
+    try:
+        from PIL import Image
+        return Image
+    except ImportError:
+        if not _pillow_warned:
+            logger.warning("Pillow is not installed; images are delivered as the original PNG")
+            _pillow_warned = True
+        return None
+
+
+def encode_image(png: bytes, image_format: str = None, quality: int = None, sizes=None):
+    # Returns [(width, extension, content type, bytes)], one per requested width.
+    image_format = image_format or IMAGE_FORMAT
+    quality = quality or IMAGE_QUALITY
+    sizes = sizes or IMAGE_SIZES or [0]
+    if image_format not in FORMATS:
+        raise ValueError(f"Unknown image format: {image_format}")
+    Image = load_pillow() if image_format != 'png' or sizes != [0] else None
+    if Image is None:
+        return [(0, '.png', 'image/png', png)]
+
+    original = Image.open(io.BytesIO(png))
+    original.load()
+    if image_format == 'jpeg' and original.mode not in ('RGB', 'L'):
+        original = original.convert('RGB')
+    pil_format, content_type = FORMATS[image_format]
+    variants = []
+    for width in sizes:
+        image = original
+        if width and width < original.width:
+            image = original.resize((width, round(original.height * width / original.width)), Image.LANCZOS)
+        out = io.BytesIO()
+        options = {'optimize': True} if pil_format != 'WEBP' else {'method': 4}
+        if pil_format != 'PNG':
+            options['quality'] = quality
+        image.save(out, format=pil_format, **options)
+        variants.append((width or original.width, f".{image_format}", content_type, out.getvalue()))
+    return variants
+
+
+def image_key(png: bytes) -> str:
+    # Stored names depend on the encoding settings and widths too, so changing
+    # them never serves a blob encoded under the old ones.
+    digest = hashlib.sha256(png)
+    digest.update(f"{IMAGE_FORMAT}:{IMAGE_QUALITY}:{IMAGE_SIZES or [0]}".encode('ascii'))
+    return digest.hexdigest()[:32]
+
+
+def variant_name(key: str, width: int, extension: str, primary: bool) -> str:
+    return f"{key}{extension}" if primary else f"{key}-{width}w{extension}"
+
+
+class LocalBlobStore:
+    def __init__(self, path: str = None, base_url: str = None, max_bytes: int = None):
+        self.path = path or IMAGE_STORE_PATH
+        self.base_url = (base_url if base_url is not None else IMAGE_BASE_URL).rstrip('/')
+        self.max_bytes = IMAGE_STORE_MAX_BYTES if max_bytes is None else max_bytes
+        # A store under /tmp is private to one Lambda execution environment.
+        self.shared = not (ON_LAMBDA and is_local_path(self.path))
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.bytes = sum(size for _, _, size in self.blobs())
+
+    def blobs(self):
+        # [(mtime, path, size)] for every stored image.
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def blob_path(self, name: str) -> str:
+        # Names are generated by variant_name; anything else never maps to a file.
+        if not name or '/' in name or '\\' in name or name.startswith('.'):
+            return None
+        return os.path.join(self.path, name)
+
+    def put(self, name: str, data: bytes, content_type: str):
+        path = self.blob_path(name)
+        if os.path.exists(path):
+            return  # content-addressed: same name, same bytes
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.bytes += len(data)
+            if self.max_bytes and self.bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Rescans rather than trusting self.bytes, since other processes may
+        # share the directory; reads refresh mtime, so the oldest go first.
+        entries = sorted(self.blobs())
+        total = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.bytes = total
+
+    def get(self, name: str):
+        path = self.blob_path(name)
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None  # evicted in the meantime
+        return data, CONTENT_TYPES.get(os.path.splitext(name)[1], 'application/octet-stream')
+
+    def url(self, name: str) -> str:
+        return f"{self.base_url}/{name}"
+
+
+class S3BlobStore:
+    def __init__(self, bucket: str = None, prefix: str = None, base_url: str = None):
+        import boto3  # provided by the Lambda runtime
+        self.bucket = bucket or IMAGE_STORE_BUCKET
+        if not self.bucket:
+            raise ValueError("IMAGE_STORE_BUCKET must be set for the s3 image store")
+        self.prefix = IMAGE_STORE_PREFIX if prefix is None else prefix
+        # The default base URL is this service's own route, which can't serve S3
+        # objects; without an explicit one, presigned URLs are used.
+        self.base_url = base_url if base_url is not None else os.environ.get('IMAGE_BASE_URL')
+        self.shared = True
+        self.s3 = boto3.client('s3')
+
+    def put(self, name: str, data: bytes, content_type: str):
+        self.s3.put_object(
+            Bucket=self.bucket, Key=f"{self.prefix}{name}", Body=data, ContentType=content_type,
+            CacheControl='public, max-age=31536000, immutable'
+        )
+
+    def get(self, name: str):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{name}")
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return obj['Body'].read(), obj.get('ContentType', 'application/octet-stream')
+
+    def url(self, name: str) -> str:
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{self.prefix}{name}"
+        return self.s3.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': f"{self.prefix}{name}"}, ExpiresIn=IMAGE_URL_TTL
+        )
+
+
+IMAGE_STORE_ERROR = (
+    "IMAGE_DELIVERY=url on Lambda needs an image store every invocation can reach: set IMAGE_STORE=s3, "
+    "or IMAGE_STORE_PATH to a shared mount such as EFS"
+)
+BLOB_STORES = {
+    'local': LocalBlobStore,
+    's3': S3BlobStore,
+}
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+def make_blob_store(backend: str = None):
+    backend = (backend or IMAGE_STORE).lower()
+    if backend not in BLOB_STORES:
+        raise ValueError(f"Unknown image store: {backend}")
+    return BLOB_STORES[backend]()
+
+
+def get_blob_store():
+    global _blob_store
+    if _blob_store is None:
+        with _blob_store_lock:
+            if _blob_store is None:
+                _blob_store = make_blob_store()
+                if IMAGE_DELIVERY == 'url' and not _blob_store.shared:
+                    logger.warning(f"Images are delivered inline. {IMAGE_STORE_ERROR}")
+    return _blob_store
+
+
+def deliver_image(image_b64: str, delivery: str = None) -> str:
+    # Stability's base64 PNG in, an <img src> value out: a data URI or a URL.
+    delivery = delivery or IMAGE_DELIVERY
+    if delivery not in DELIVERY_MODES:
+        raise ValueError(f"Unknown image delivery: {delivery}")
+    png = base64.b64decode(image_b64)
+    if delivery == 'url' and not get_blob_store().shared:
+        delivery = 'inline'
+    if delivery == 'inline':
+        _, _, content_type, data = encode_image(png, sizes=(IMAGE_SIZES or [0])[:1])[0]
+        return f"data:{content_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+    key = image_key(png)
+    store = get_blob_store()
+    names = []
+    for index, (width, extension, content_type, data) in enumerate(encode_image(png)):
+        name = variant_name(key, width, extension, primary=index == 0)
+        store.put(name, data, content_type)
+        names.append(name)
+    return store.url(names[0])
+
+
+def image_etag(name: str) -> str:
+    return f'"{os.path.splitext(name)[0]}"'
@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from time import time
+
+# Job records for the asynchronous API. The SQLite store suits a single host;
+# the file store writes one JSON document per job and can sit on a shared
+# mount (e.g. EFS) so submit and worker invocations see the same jobs. A store
+# under /tmp is private to one Lambda execution environment and is never
+# treated as shared.
+JOB_STORE = os.environ.get('JOB_STORE', 'sqlite')
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', '/tmp/medblog-jobs')
+JOB_TTL = float(os.environ.get('JOB_TTL', '86400'))
+
+JOB_STAGES = ('competitors', 'comparison', 'blog', 'image')
+
+
+def new_job(request):
+    now = time()
+    return {
+        'jobId': uuid.uuid4().hex,
+        'status': 'queued',
+        'createdAt': now,
+        'updatedAt': now,
+        'request': request,
+        'stages': {stage: {'status': 'pending'} for stage in JOB_STAGES},
+        'artifacts': {},
+        'error': None,
+    }
+
+
+def is_expired(job) -> bool:
+    return time() - job['updatedAt'] > JOB_TTL
+
+
+def is_local_path(path: str) -> bool:
+    path = os.path.realpath(path)
+    return path == '/tmp' or path.startswith('/tmp/')
+
+
+class SQLiteJobStore:
+    # SQLite's locking isn't safe on network file systems, so never shared.
+    shared = False
+
+    def __init__(self, path: str = None):
+        path = path or JOB_STORE_PATH
+        self.path = path if path.endswith('.sqlite3') else os.path.join(path, 'jobs.sqlite3')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def put(self, job):
+        job['updatedAt'] = time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, data, updated_at) VALUES (?, ?, ?)",
+                (job['jobId'], json.dumps(job), job['updatedAt'])
+            )
+            self.conn.execute("DELETE FROM jobs WHERE updated_at < ?", (time() - JOB_TTL,))
+
+    def get(self, job_id: str):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[0])
+        return None if is_expired(job) else job
+
+
+class FileJobStore:
+    def __init__(self, path: str = None):
+        self.path = path or JOB_STORE_PATH
+        self.shared = not is_local_path(self.path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def job_path(self, job_id: str) -> str:
+        # Job ids are uuid4 hex; anything else never maps to a file.
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        return os.path.join(self.path, f"{job_id}.json")
+
+    def put(self, job):
+        job['updatedAt'] = time()
+        path = self.job_path(job['jobId'])
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def get(self, job_id: str):
+        path = self.job_path(job_id)
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            job = json.load(f)
+        if is_expired(job):
+            os.remove(path)
+            return None
+        return job
+
+
+JOB_STORES = {
+    'sqlite': SQLiteJobStore,
+    'file': FileJobStore,
+}
+
+
+def make_job_store(backend: str = None, path: str = None):
+    backend = (backend or JOB_STORE).lower()
+    if backend not in JOB_STORES:
+        raise ValueError(f"Unknown job store: {backend}")
+    return JOB_STORES[backend](path=path)
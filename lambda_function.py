@@ -3,21 +3,312 @@ import os
 import base64
 import ast
 import re
-import requests
-from bs4 import BeautifulSoup
-from time import sleep
-import anthropic
+import hashlib
+import sys
+import threading
+from time import monotonic, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from contextlib import ExitStack
+from urllib.parse import urlparse, urldefrag
 import logging
 
+from cache import SingleFlight, make_cache, normalize_query
+from context import build_context
+from html_text import extract_visible_text
+from images import deliver_image, get_blob_store, image_etag
+from jobs import make_job_store, new_job
+from ranking import rank_results
+from rate_limiter import TokenBucket, parse_retry_after
+from resilience import (
+    RETRY_STATUSES, CircuitOpen, DeadlineExceeded, UpstreamError, breaker_states, call, check_deadline,
+    deadline_scope, env_overrides, hedged, is_rate_limited, time_left, until_deadline
+)
+from tracing import span, submit, trace_request, traced
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-ANTHROPIC_API_KEY = os.environ['ANTHROPIC_API_KEY']
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# The anthropic SDK and the pooled HTTP session (requests) are the slowest
+# imports by far, so they are loaded and built on first use and then reused by
+# warm invocations. API keys are read when a call needs them: a missing key
+# fails that call rather than module load. LAZY_INIT=false builds everything
+# during init instead, for provisioned concurrency where init is not billed
+# to a request.
+LAZY_INIT = os.environ.get('LAZY_INIT', 'true').lower() in ('1', 'true', 'yes')
+_client = None
+_client_lock = threading.Lock()
+
+def api_key(name: str) -> str:
+    key = os.environ.get(name)
+    if not key:
+        raise KeyError(f"{name} is not set")
+    return key
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import anthropic
+                _client = anthropic.Anthropic(api_key=api_key('ANTHROPIC_API_KEY'))
+    return _client
+
+def get_http_session():
+    from http_client import http_session
+    return http_session
+
+def http_pool_stats():
+    # Only reported once the session exists; asking for stats shouldn't build it.
+    if 'http_client' not in sys.modules:
+        return None
+    return sys.modules['http_client'].pool_stats()
+
 MODEL_NAME = "claude-3-opus-20240229"
+SYSTEM_PROMPT = "You are a helpful AI assistant."
+TEMPERATURE = 0.5
+
+# Model routing per completion stage: the model, max_tokens, timeout (seconds)
+# and retries for each call. Short, mechanical stages go to a fast model; the
+# comparison and the post itself stay on MODEL_NAME. A call that still times
+# out or finds the model overloaded after its retries, or whose model's circuit
+# breaker is open, is retried on the route's fallback model.
+# MODEL_ROUTES (JSON) overrides fields per stage, e.g.
+# {"search_queries": {"model": "claude-3-opus-20240229", "timeout": 30}}.
+FAST_MODEL = os.environ.get('FAST_MODEL', 'claude-3-haiku-20240307')
+FALLBACK_MODEL = os.environ.get('FALLBACK_MODEL', 'claude-3-5-sonnet-20240620')
+DEFAULT_ROUTE = {'model': MODEL_NAME, 'max_tokens': 2048, 'timeout': 120, 'retries': 1, 'fallback': FALLBACK_MODEL}
+MODEL_ROUTES = {
+    'search_queries': {'model': FAST_MODEL, 'max_tokens': 200, 'timeout': 15},
+    'image_prompt': {'model': FAST_MODEL, 'max_tokens': 100, 'timeout': 15},
+    'compare': {'model': MODEL_NAME, 'max_tokens': 1500, 'timeout': 120},
+    'blog_post': {'model': MODEL_NAME, 'max_tokens': 1500, 'timeout': 120},
+}
+for _stage, _overrides in env_overrides('MODEL_ROUTES').items():
+    MODEL_ROUTES[_stage] = {**MODEL_ROUTES.get(_stage, {}), **_overrides}
+# Anthropic statuses that mean "try elsewhere": rate limited, unavailable, overloaded.
+OVERLOAD_STATUSES = {429, 503, 529}
+
+# Completions are cached by a hash of everything that shapes the output. Only
+# the stages listed in COMPLETION_CACHE_STAGES read from or write to it.
+COMPLETION_STAGES = ('search_queries', 'compare', 'blog_post', 'image_prompt')
+COMPLETION_CACHE_STAGES = {
+    stage.strip() for stage in os.environ.get('COMPLETION_CACHE_STAGES', ','.join(COMPLETION_STAGES)).split(',')
+    if stage.strip()
+}
+# Completions are streamed so every stage reports time to first token and
+# output tokens/sec; STREAM_COMPLETIONS=false falls back to blocking calls.
+STREAM_COMPLETIONS = os.environ.get('STREAM_COMPLETIONS', 'true').lower() in ('1', 'true', 'yes')
+COMPLETION_CACHE_TTL = float(os.environ.get('COMPLETION_CACHE_TTL', '604800'))
+COMPLETION_CACHE_MAX_ENTRIES = int(os.environ.get('COMPLETION_CACHE_MAX_ENTRIES', '5000'))
+COMPLETION_CACHE_MAX_BYTES = int(os.environ.get('COMPLETION_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+completion_cache = make_cache(
+    'completions',
+    backend=os.environ.get('COMPLETION_CACHE_BACKEND'),
+    max_entries=COMPLETION_CACHE_MAX_ENTRIES,
+    max_bytes=COMPLETION_CACHE_MAX_BYTES,
+    ttl=COMPLETION_CACHE_TTL
+)
+
+# Caps on concurrent calls to each upstream service, shared by every request
+# (and batch worker) in the process.
+SERVICE_CONCURRENCY = {
+    'brave': int(os.environ.get('BRAVE_CONCURRENCY', '4')),
+    'anthropic': int(os.environ.get('ANTHROPIC_CONCURRENCY', '8')),
+    'stability': int(os.environ.get('STABILITY_CONCURRENCY', '2')),
+}
+service_slots = {name: threading.BoundedSemaphore(limit) for name, limit in SERVICE_CONCURRENCY.items()}
+
+BRAVE_SEARCH_URL = os.environ.get('BRAVE_SEARCH_URL', "https://api.search.brave.com/res/v1/web/search")
+STABILITY_API_HOST = os.environ.get('STABILITY_API_HOST', 'https://api.stability.ai')
+
+# Every Brave call draws from one bucket, so parallel searches stay inside the
+# plan's quota without a fixed sleep after each call.
+BRAVE_QPS = float(os.environ.get('BRAVE_QPS', '1'))
+BRAVE_BURST = int(os.environ.get('BRAVE_BURST', '1'))
+BRAVE_MAX_RETRIES = int(os.environ.get('BRAVE_MAX_RETRIES', '2'))
+brave_limiter = TokenBucket(BRAVE_QPS, BRAVE_BURST)
+
+search_flight = SingleFlight()
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', '86400'))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', '5000'))
+SEARCH_CACHE_MAX_BYTES = int(os.environ.get('SEARCH_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+search_cache = make_cache(
+    'brave_search',
+    backend=os.environ.get('SEARCH_CACHE_BACKEND'),
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    max_bytes=SEARCH_CACHE_MAX_BYTES,
+    ttl=SEARCH_CACHE_TTL
+)
+
+# Extracted page text is cached per URL. Within PAGE_CACHE_FRESH seconds it is
+# served without touching the network; after that it is revalidated with a
+# conditional GET until PAGE_CACHE_TTL expires the entry outright.
+PAGE_TEXT_LIMIT = 1500
+# Pages are streamed and parsed incrementally; reading stops at the text limit
+# or after PAGE_MAX_BYTES of body, whichever comes first.
+PAGE_MAX_BYTES = int(os.environ.get('PAGE_MAX_BYTES', str(1024 * 1024)))
+PAGE_CHUNK_SIZE = 16 * 1024
+PAGE_CACHE_FRESH = float(os.environ.get('PAGE_CACHE_FRESH', '3600'))
+PAGE_CACHE_TTL = float(os.environ.get('PAGE_CACHE_TTL', '604800'))
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', '20000'))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', str(48 * 1024 * 1024)))
+page_cache = make_cache(
+    'page_text',
+    backend=os.environ.get('PAGE_CACHE_BACKEND'),
+    max_entries=PAGE_CACHE_MAX_ENTRIES,
+    max_bytes=PAGE_CACHE_MAX_BYTES,
+    ttl=PAGE_CACHE_TTL
+)
+page_flight = SingleFlight()
+
+# Generated images are cached by everything that shapes the render: engine,
+# normalized prompt, size, steps, cfg_scale, seed and sample count. Every
+# request passes a seed (IMAGE_SEED, or one derived from the prompt when unset)
+# so a render is reproducible and a cached one is what a new generation would
+# have returned. With IMAGE_SAMPLES > 1 each generation asks for that many
+# samples and keeps them all; later hits on the same key rotate through the
+# pool, and raising IMAGE_SAMPLES starts a new, larger one.
+STABILITY_ENGINE = os.environ.get('STABILITY_ENGINE', 'stable-diffusion-v1-6')
+IMAGE_STEPS = int(os.environ.get('IMAGE_STEPS', '30'))
+IMAGE_CFG_SCALE = float(os.environ.get('IMAGE_CFG_SCALE', '7'))
+IMAGE_SEED = os.environ.get('IMAGE_SEED', '')
+IMAGE_SAMPLES = int(os.environ.get('IMAGE_SAMPLES', '1'))
+# Stability accepts seeds in [0, 4294967295); 0 would mean "random".
+MAX_IMAGE_SEED = 4294967294
+IMAGE_CACHE_TTL = float(os.environ.get('IMAGE_CACHE_TTL', '604800'))
+IMAGE_CACHE_MAX_ENTRIES = int(os.environ.get('IMAGE_CACHE_MAX_ENTRIES', '200'))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+image_cache = make_cache(
+    'images',
+    backend=os.environ.get('IMAGE_CACHE_BACKEND'),
+    max_entries=IMAGE_CACHE_MAX_ENTRIES,
+    max_bytes=IMAGE_CACHE_MAX_BYTES,
+    ttl=IMAGE_CACHE_TTL
+)
+image_flight = SingleFlight()
+# Next pool index per image key, so repeated hits hand out different variants.
+variant_turns = {}
+variant_turns_lock = threading.Lock()
+
+# 'parallel' prompts the image from the drug details and comparison so it can be
+# generated while the blog post is written; 'strict' waits for the finished post
+# and derives the image from it; 'sections' derives it from the post's first
+# IMAGE_SECTIONS sections, starting as soon as they have streamed in. Requests
+# can override with "imageMode".
+IMAGE_MODES = ('parallel', 'strict', 'sections')
+IMAGE_MODE = os.environ.get('IMAGE_MODE', 'parallel')
+IMAGE_SECTIONS = int(os.environ.get('IMAGE_SECTIONS', '2'))
+# A section ends at a blank line followed by a markdown or bold heading.
+SECTION_BREAK = re.compile(r'\n[ \t]*\n(?=[ \t]*(#|\*\*))')
+stage_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('STAGE_WORKERS', '4')), thread_name_prefix='stage')
+
+# Whole responses are cached by normalized request body, and identical requests
+# that arrive while one is being generated wait for it instead of starting over.
+REQUEST_CACHE_TTL = float(os.environ.get('REQUEST_CACHE_TTL', '3600'))
+REQUEST_CACHE_MAX_ENTRIES = int(os.environ.get('REQUEST_CACHE_MAX_ENTRIES', '500'))
+REQUEST_CACHE_MAX_BYTES = int(os.environ.get('REQUEST_CACHE_MAX_BYTES', str(48 * 1024 * 1024)))
+request_cache = make_cache(
+    'responses',
+    backend=os.environ.get('REQUEST_CACHE_BACKEND'),
+    max_entries=REQUEST_CACHE_MAX_ENTRIES,
+    max_bytes=REQUEST_CACHE_MAX_BYTES,
+    ttl=REQUEST_CACHE_TTL
+)
+request_flight = SingleFlight()
+STAGE_ERROR_PREFIX = "An error occurred while"
+
+# Each stage's output is also cached on its own, keyed by a hash of just the
+# inputs it reads (STAGE_GRAPH) and the models routed to it. Upstream outputs
+# enter the key by content hash, so a request that only changes drugDetails
+# reuses the search queries and competitor pages and recomputes the
+# comparison, post and image. Responses report which stages were reused.
+STAGE_GRAPH = {
+    'queries': ('drugName',),
+    'competitors': ('drugName', 'queries'),
+    'comparison': ('drugName', 'drugDetails', 'competitors'),
+    'blog': ('drugName', 'drugDetails', 'comparison'),
+}
+# The image is prompted from different material in each image mode.
+IMAGE_STAGE_INPUTS = {
+    'parallel': ('drugName', 'drugDetails', 'comparison'),
+    'strict': ('drugName', 'blog'),
+    'sections': ('drugName', 'opening'),
+}
+STAGE_ROUTES = {
+    'queries': ('search_queries',),
+    'comparison': ('compare',),
+    'blog': ('blog_post',),
+    'image': ('image_prompt',),
+}
+STAGE_CACHE_TTL = float(os.environ.get('STAGE_CACHE_TTL', '86400'))
+STAGE_CACHE_MAX_ENTRIES = int(os.environ.get('STAGE_CACHE_MAX_ENTRIES', '2000'))
+STAGE_CACHE_MAX_BYTES = int(os.environ.get('STAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+stage_cache = make_cache(
+    'stages',
+    backend=os.environ.get('STAGE_CACHE_BACKEND'),
+    max_entries=STAGE_CACHE_MAX_ENTRIES,
+    max_bytes=STAGE_CACHE_MAX_BYTES,
+    ttl=STAGE_CACHE_TTL
+)
+
+# Every request logs one structured JSON line with its per-stage timings and
+# token usage; set INCLUDE_TIMINGS (or "timings": true in the body) to also
+# return them in the response.
+INCLUDE_TIMINGS = os.environ.get('INCLUDE_TIMINGS', 'false').lower() in ('1', 'true', 'yes')
+
+# Asynchronous jobs: 'submit' stores a job and hands it to a worker, which runs
+# the streaming pipeline and records each stage's artifacts as it completes.
+# On Lambda the worker is an async self-invocation, so JOB_STORE must then
+# point at storage both invocations can reach (the file store on EFS);
+# submitting is refused until it does.
+JOB_ACTIONS = ('submit', 'status', 'result')
+JOB_RUNNER = os.environ.get('JOB_RUNNER', 'lambda' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else 'thread')
+job_store = make_job_store()
+JOB_STORE_ERROR = (
+    "JOB_RUNNER=lambda needs a job store every invocation can reach: set JOB_STORE=file and "
+    "JOB_STORE_PATH to a shared mount such as EFS, or JOB_RUNNER=thread"
+)
+if JOB_RUNNER == 'lambda' and not job_store.shared:
+    logger.warning(f"Async jobs are disabled. {JOB_STORE_ERROR}")
+job_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('JOB_WORKERS', '2')), thread_name_prefix='job')
+
+# Every request runs against a deadline that the outbound calls it makes (see
+# resilience.py) respect: REQUEST_DEADLINE seconds (0 for none), and on Lambda
+# no later than DEADLINE_MARGIN seconds before the invocation would time out,
+# so there is still time to return whatever finished.
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '0'))
+DEADLINE_MARGIN = float(os.environ.get('DEADLINE_MARGIN', '3'))
 
-BRAVE_API_KEY = os.environ['BRAVE_API_KEY']
-STABILITY_API_KEY = os.environ['STABILITY_API_KEY']
+# Retrieval fan-out: searches and page fetches share one pool, with a cap on
+# in-flight requests per host and a single deadline for the whole stage.
+RETRIEVAL_WORKERS = int(os.environ.get('RETRIEVAL_WORKERS', '8'))
+RETRIEVAL_PER_HOST = int(os.environ.get('RETRIEVAL_PER_HOST', '3'))
+RETRIEVAL_DEADLINE = float(os.environ.get('RETRIEVAL_DEADLINE', '30'))
+# Retrieved text is condensed before it goes into a prompt (see context.py):
+# boilerplate and repeated sentences are dropped and the most relevant
+# sentences kept within each stage's token budget. 0 disables condensing.
+COMPARE_CONTEXT_TOKENS = int(os.environ.get('COMPARE_CONTEXT_TOKENS', '700'))
+IMAGE_CONTEXT_TOKENS = int(os.environ.get('IMAGE_CONTEXT_TOKENS', '300'))
+ITEM_PATTERN = re.compile(
+    r'(<item index="\d+">\n<source>.*?</source>\n<page_content>\n)(.*?)(</page_content>\n</item>)', re.DOTALL
+)
+
+# Search hits from every query are ranked together (see ranking.py) and only
+# the top MAX_COMPETITOR_PAGES are fetched.
+MAX_COMPETITOR_PAGES = int(os.environ.get('MAX_COMPETITOR_PAGES', '3'))
+
+retrieval_pool = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix='retrieval')
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+def set_service_concurrency(**limits):
+    # e.g. set_service_concurrency(brave=2, anthropic=4); callers already inside
+    # a slot keep the semaphore they acquired.
+    for name, limit in limits.items():
+        if name not in service_slots:
+            raise ValueError(f"Unknown service: {name}")
+        SERVICE_CONCURRENCY[name] = limit
+        service_slots[name] = threading.BoundedSemaphore(limit)
 
 def extract_text(obj):
     if hasattr(obj, 'text'):
@@ -29,23 +320,168 @@ def extract_text(obj):
     else:
         return str(obj)
 
-def get_completion(prompt: str, max_tokens=2048):
-    try:
-        message = client.messages.create(
-            model=MODEL_NAME,
-            max_tokens=max_tokens,
-            temperature=0.5,
-            system="You are a helpful AI assistant.",
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return extract_text(message.content)
-    except Exception as e:
-        print(f"Error in get_completion: {str(e)}")
-        raise
+def completion_key(model: str, system: str, prompt: str, max_tokens: int, temperature: float) -> str:
+    payload = json.dumps([model, system, prompt, max_tokens, temperature])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def record_usage(attrs, usage):
+    if usage is not None:
+        attrs['inputTokens'] = getattr(usage, 'input_tokens', 0) or 0
+        attrs['outputTokens'] = getattr(usage, 'output_tokens', 0) or 0
+
+def completion_route(stage: str = None):
+    return {**DEFAULT_ROUTE, **MODEL_ROUTES.get(stage, {})}
+
+def route_models(route):
+    models = [route['model']]
+    if route.get('fallback') and route['fallback'] != route['model']:
+        models.append(route['fallback'])
+    return models
+
+def is_overload(e) -> bool:
+    import anthropic
+    if isinstance(e, anthropic.APITimeoutError):
+        return True
+    return isinstance(e, anthropic.APIStatusError) and e.status_code in OVERLOAD_STATUSES
+
+def is_transient(e) -> bool:
+    # Worth retrying, and counted against the model's circuit breaker.
+    import anthropic
+    if isinstance(e, anthropic.APIConnectionError):
+        return True
+    return isinstance(e, anthropic.APIStatusError) and (e.status_code in OVERLOAD_STATUSES or e.status_code >= 500)
+
+def can_fall_back(e) -> bool:
+    return is_overload(e) or isinstance(e, CircuitOpen)
+
+def routed_client(timeout: float):
+    # Retries are left to resilience.call, which also knows the deadline.
+    return get_client().with_options(timeout=timeout, max_retries=0)
+
+def get_completion(prompt: str, max_tokens: int = None, stage: str = None, bypass_cache: bool = False):
+    # max_tokens defaults to the stage's route.
+    if STREAM_COMPLETIONS:
+        return ''.join(stream_completion(prompt, max_tokens, stage=stage, bypass_cache=bypass_cache))
+    route = completion_route(stage)
+    with span('get_completion', stage=stage, model=route['model']) as attrs:
+        return _get_completion(prompt, max_tokens or route['max_tokens'], stage, route, bypass_cache, attrs)
+
+def _get_completion(prompt: str, max_tokens: int, stage: str, route, bypass_cache: bool, attrs):
+    use_cache = stage in COMPLETION_CACHE_STAGES
+    key = completion_key(route['model'], SYSTEM_PROMPT, prompt, max_tokens, TEMPERATURE) if use_cache else None
+    if use_cache and not bypass_cache:
+        cached = completion_cache.get(key)
+        if cached is not None:
+            attrs['cached'] = True
+            return cached
+
+    models = route_models(route)
+    for model in models:
+        def create(timeout):
+            with service_slots['anthropic']:
+                return routed_client(timeout).messages.create(
+                    model=model,
+                    max_tokens=max_tokens,
+                    temperature=TEMPERATURE,
+                    system=SYSTEM_PROMPT,
+                    messages=[
+                        {"role": "user", "content": prompt}
+                    ]
+                )
+        try:
+            message = call(
+                'anthropic', create, key=model, timeout=route['timeout'], retries=route['retries'],
+                is_failure=is_transient
+            )
+            text = extract_text(message.content)
+            record_usage(attrs, getattr(message, 'usage', None))
+            break
+        except Exception as e:
+            if model != models[-1] and can_fall_back(e):
+                print(f"{model} unavailable for {stage} ({type(e).__name__}), falling back to {models[-1]}")
+                attrs.update(model=models[-1], fallback=True)
+                continue
+            print(f"Error in get_completion: {str(e)}")
+            raise
 
-def generate_search_queries(drug_name: str):
+    # A bypassed read still refreshes the entry for later requests. Fallback
+    # output is not cached, so the next request tries the routed model again.
+    if use_cache and not attrs.get('fallback'):
+        completion_cache.set(key, text)
+    return text
+
+def stream_completion(prompt: str, max_tokens: int = None, stage: str = None, bypass_cache: bool = False):
+    # Same contract as get_completion, but yields text deltas as they arrive. A
+    # cache hit is yielded as a single delta.
+    route = completion_route(stage)
+    max_tokens = max_tokens or route['max_tokens']
+    use_cache = stage in COMPLETION_CACHE_STAGES
+    key = completion_key(route['model'], SYSTEM_PROMPT, prompt, max_tokens, TEMPERATURE) if use_cache else None
+    if use_cache and not bypass_cache:
+        cached = completion_cache.get(key)
+        if cached is not None:
+            with span('get_completion', stage=stage, model=route['model'], cached=True):
+                pass
+            yield cached
+            return
+
+    parts = []
+    models = route_models(route)
+    with span('get_completion', stage=stage, model=route['model'], streamed=True) as attrs:
+        for model in models:
+            try:
+                with service_slots['anthropic'], ExitStack() as stack:
+                    def open_stream(timeout):
+                        return stack.enter_context(routed_client(timeout).messages.stream(
+                            model=model,
+                            max_tokens=max_tokens,
+                            temperature=TEMPERATURE,
+                            system=SYSTEM_PROMPT,
+                            messages=[
+                                {"role": "user", "content": prompt}
+                            ]
+                        ))
+                    # Timed from the request, so first-token latency includes the
+                    # time to first byte but not the wait for a slot.
+                    started = monotonic()
+                    # Only opening the stream is retried; the timeout then applies
+                    # to each read, so a stalled stream still fails.
+                    stream = call(
+                        'anthropic', open_stream, key=model, timeout=route['timeout'], retries=route['retries'],
+                        is_failure=is_transient
+                    )
+                    first_token = None
+                    for text in stream.text_stream:
+                        if first_token is None:
+                            first_token = monotonic()
+                            attrs['firstTokenMs'] = round((first_token - started) * 1000, 1)
+                        parts.append(text)
+                        yield text
+                        check_deadline(stage or 'completion')
+                    record_usage(attrs, getattr(stream.get_final_message(), 'usage', None))
+                    # Rate after the first token, so it reflects generation speed
+                    # rather than queueing and prompt processing.
+                    generating = monotonic() - first_token if first_token is not None else 0
+                    if generating > 0:
+                        attrs['tokensPerSec'] = round(attrs.get('outputTokens', len(parts)) / generating, 1)
+                break
+            except Exception as e:
+                # Once text has been yielded the consumer has it, so only a
+                # failure before the first delta can move to the fallback.
+                if model != models[-1] and not parts and can_fall_back(e):
+                    print(f"{model} unavailable for {stage} ({type(e).__name__}), falling back to {models[-1]}")
+                    attrs.update(model=models[-1], fallback=True)
+                    continue
+                print(f"Error in stream_completion: {str(e)}")
+                raise
+
+    if use_cache and not attrs.get('fallback'):
+        completion_cache.set(key, ''.join(parts))
+
+@traced('generate_search_queries')
+def generate_search_queries(drug_name: str, bypass_cache: bool = False, on_fallback=None):
+    # on_fallback, if given, is called when the generic queries below stand in
+    # for the model's.
     GENERATE_QUERIES = f"""
     Generate three search queries to find top competitors for this drug. Output only the list of queries.
 
@@ -56,7 +492,7 @@ def generate_search_queries(drug_name: str):
     """
     
     try:
-        response = get_completion(GENERATE_QUERIES)
+        response = get_completion(GENERATE_QUERIES, stage='search_queries', bypass_cache=bypass_cache)
         print(f"Raw response from API: {response}")
         
         try:
@@ -78,53 +514,205 @@ def generate_search_queries(drug_name: str):
             f"{drug_name} competitors"
         ]
         print(f"Using fallback queries: {fallback_queries}")
+        if on_fallback is not None:
+            on_fallback()
         return fallback_queries
 
+@traced('get_search_results')
 def get_search_results(search_query: str):
-    headers = {"Accept": "application/json", "X-Subscription-Token": BRAVE_API_KEY}
-    response = requests.get(
-        "https://api.search.brave.com/res/v1/web/search",
-        params={"q": search_query, "count": 5},
-        headers=headers,
-        timeout=60
-    )
-    if not response.ok:
-        raise Exception(f"HTTP error {response.status_code}")
-    sleep(1)  # avoid Brave rate limit
-    return response.json().get("web", {}).get("results")
+    headers = {"Accept": "application/json", "X-Subscription-Token": api_key('BRAVE_API_KEY')}
 
+    def search(timeout):
+        if not brave_limiter.acquire(timeout=time_left()):
+            raise DeadlineExceeded("brave: no search quota left before the request deadline")
+        with service_slots['brave']:
+            response = get_http_session().get(
+                BRAVE_SEARCH_URL,
+                params={"q": search_query, "count": 5},
+                headers=headers,
+                timeout=timeout
+            )
+        if response.status_code == 429:
+            # Every search waits out the window, not just this one.
+            retry_after = parse_retry_after(response.headers.get("Retry-After"), default=1 / BRAVE_QPS)
+            brave_limiter.pause(retry_after)
+            raise UpstreamError('brave', 429, retry_after=retry_after)
+        if not response.ok:
+            raise UpstreamError('brave', response.status_code)
+        return response.json().get("web", {}).get("results")
+
+    # Rate limiting is retried after Retry-After but doesn't trip the breaker.
+    return call('brave', search, retries=BRAVE_MAX_RETRIES, is_throttled=is_rate_limited)
+
+def get_cached_search_results(search_query: str):
+    key = f"q={normalize_query(search_query)}&count=5"
+    results = search_cache.get(key)
+    if results is None:
+        def fetch():
+            fetched = get_search_results(search_query) or []
+            search_cache.set(key, fetched)
+            return fetched
+        # Requests that need the same search at the same time share one call.
+        results, _ = search_flight.do(key, fetch)
+    return results
+
+def page_encoding(response):
+    # requests assumes ISO-8859-1 for text/* without a charset; only trust an
+    # explicit one and let the extractor default to UTF-8 otherwise.
+    if 'charset' in response.headers.get('Content-Type', '').lower():
+        return response.encoding
+    return None
+
+@traced('get_page_content')
 def get_page_content(url: str) -> str:
+    text, _ = page_flight.do(urldefrag(url)[0], lambda: fetch_page_content(url))
+    return text
+
+def fetch_page_content(url: str) -> str:
+    key = urldefrag(url)[0]
+    cached = page_cache.get(key)
+    if cached and time() - cached['fetchedAt'] < PAGE_CACHE_FRESH:
+        return cached['text']
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('lastModified'):
+        headers['If-Modified-Since'] = cached['lastModified']
+
+    def download(timeout):
+        with get_http_session().get(url, headers=headers, timeout=timeout, stream=True) as response:
+            if response.status_code in RETRY_STATUSES:
+                raise UpstreamError('pages', response.status_code)
+            if response.status_code == 304:
+                return response, None
+            return response, extract_visible_text(
+                until_deadline(response.iter_content(PAGE_CHUNK_SIZE)),
+                limit=PAGE_TEXT_LIMIT,
+                max_bytes=PAGE_MAX_BYTES,
+                encoding=page_encoding(response)
+            )
+
     try:
-        response = requests.get(url, timeout=10)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        return soup.get_text(strip=True, separator='\n')[:1500]  
+        # Each host has its own breaker, so one failing site doesn't block the rest.
+        host = urlparse(url).netloc.lower()
+        response, text = hedged('pages', lambda: call('pages', download, key=host), slot=host_slot(url))
+        if cached and response.status_code == 304:
+            cached['fetchedAt'] = time()
+            page_cache.set(key, cached)
+            return cached['text']
+
+        if response.ok:
+            page_cache.set(key, {
+                'text': text,
+                'etag': response.headers.get('ETag'),
+                'lastModified': response.headers.get('Last-Modified'),
+                'fetchedAt': time()
+            })
+        return text or ""
     except Exception as e:
-        print(f"Error fetching content from {url}: {str(e)}")
-        return ""
+        # A stale copy beats nothing; without one the caller decides what a
+        # missing page means for its stage.
+        if cached:
+            print(f"Error fetching content from {url}, serving cached copy: {str(e)}")
+            return cached['text']
+        raise
+
+def host_slot(url: str):
+    host = urlparse(url).netloc.lower()
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(RETRIEVAL_PER_HOST)
+        return _host_slots[host]
+
+def submit_for_host(url: str, fn, *args):
+    def task():
+        with host_slot(url):
+            return fn(*args)
+    return submit(retrieval_pool, task)
+
+@traced('find_competitor_drugs')
+def find_competitor_drugs(drug_name: str, bypass_cache: bool = False, queries=None, on_fallback=None):
+    # on_fallback, if given, is called when a search or page fetch failed or
+    # missed the deadline and the result is built from what's left.
+    if queries is None:
+        queries = generate_search_queries(drug_name, bypass_cache=bypass_cache, on_fallback=on_fallback)
+    with deadline_scope(RETRIEVAL_DEADLINE):
+        return retrieve_competitor_pages(drug_name, queries, on_fallback=on_fallback)
+
+def retrieve_competitor_pages(drug_name: str, queries, on_fallback=None):
+    # Runs inside the retrieval deadline, which the searches and page fetches
+    # inherit along with the request's own.
+    def degraded():
+        if on_fallback:
+            on_fallback()
+
+    search_futures = [submit_for_host(BRAVE_SEARCH_URL, get_cached_search_results, query) for query in queries]
+    result_lists = []
+
+    try:
+        # The searches run concurrently; ranking needs all of them, so wait
+        # for each until the deadline and rank whatever arrived.
+        for query, future in zip(queries, search_futures):
+            try:
+                result_lists.append(future.result(timeout=time_left()))
+            except FuturesTimeout:
+                print(f"Search for '{query}' missed the retrieval deadline")
+                degraded()
+            except Exception as e:
+                # One failed search shouldn't fail the stage; rank what the others found.
+                print(f"Search for '{query}' failed: {str(e)}")
+                degraded()
+    finally:
+        for future in search_futures:
+            future.cancel()
+
+    top_results = rank_results(result_lists, drug_name, limit=MAX_COMPETITOR_PAGES)
+    print(f"Ranked pages: {[(result['url'], round(result['_score'], 2)) for result in top_results]}")
+    page_futures = [submit_for_host(result.get("url"), get_page_content, result.get("url")) for result in top_results]
+    page_contents = []
+    for result, future in zip(top_results, page_futures):
+        try:
+            page_contents.append(future.result(timeout=time_left()))
+        except FuturesTimeout:
+            print(f"Error fetching content from {result.get('url')}: retrieval deadline exceeded")
+            future.cancel()
+            page_contents.append("")
+            degraded()
+        except Exception as e:
+            print(f"Error fetching content from {result.get('url')}: {str(e)}")
+            page_contents.append("")
+            degraded()
+
+    logger.info(f"Search cache: {search_cache.stats.as_dict()}, page cache: {page_cache.stats.as_dict()}")
 
-def find_competitor_drugs(drug_name: str):
-    queries = generate_search_queries(drug_name)
-    urls_seen = set()
-    web_search_results = []
-    
-    for query in queries:
-        search_results = get_search_results(query)
-        for result in search_results:
-            url = result.get("url")
-            if not url or url in urls_seen:
-                continue
-            urls_seen.add(url)
-            web_search_results.append(result)
-    
     formatted_search_results = "\n".join(
         [
-            f'<item index="{i+1}">\n<source>{result.get("url")}</source>\n<page_content>\n{get_page_content(result.get("url"))}</page_content>\n</item>'
-            for i, result in enumerate(web_search_results[:3])  
+            f'<item index="{i+1}">\n<source>{result.get("url")}</source>\n<page_content>\n{page_content}</page_content>\n</item>'
+            for i, (result, page_content) in enumerate(zip(top_results, page_contents))
         ]
     )
     return formatted_search_results
 
-def compare_drugs(original_drug: str, original_drug_details: str, competitor_info: str):
+def condense_context(stage: str, focus: str, sources, budget_tokens: int):
+    if not budget_tokens:
+        return sources
+    with span('build_context', stage=stage) as attrs:
+        condensed, report = build_context(sources, focus, budget_tokens)
+        attrs.update(report)
+    return condensed
+
+def condense_competitor_info(drug_name: str, competitor_info: str) -> str:
+    # Condenses the page text inside each <item>, keeping the item markup.
+    items = ITEM_PATTERN.findall(competitor_info)
+    if not items:
+        return competitor_info
+    pages = condense_context('compare', drug_name, [page for _, page, _ in items], COMPARE_CONTEXT_TOKENS)
+    return "\n".join(f"{head}{page}{tail}" for (head, _, tail), page in zip(items, pages))
+
+@traced('compare_drugs')
+def compare_drugs(original_drug: str, original_drug_details: str, competitor_info: str, bypass_cache: bool = False):
+    competitor_info = condense_competitor_info(original_drug, competitor_info)
     COMPARE_PROMPT = f"""
     Analyze the following information about {original_drug} and its competitors:
 
@@ -144,13 +732,13 @@ def compare_drugs(original_drug: str, original_drug_details: str, competitor_inf
     """
     
     try:
-        return get_completion(COMPARE_PROMPT, max_tokens=1500)
+        return get_completion(COMPARE_PROMPT, stage='compare', bypass_cache=bypass_cache)
     except Exception as e:
         print(f"Error in compare_drugs: {str(e)}")
         return f"An error occurred while comparing {original_drug} with its competitors. Please try again later."
 
-def generate_blog_post(drug_name: str, drug_details: str, comparison_data: str):
-    BLOG_PROMPT = f"""
+def blog_prompt(drug_name: str, drug_details: str, comparison_data: str) -> str:
+    return f"""
     Write a concise blog post about {drug_name}. Include:
     1. Brief introduction and primary uses
     2. How it works
@@ -164,125 +752,622 @@ def generate_blog_post(drug_name: str, drug_details: str, comparison_data: str):
 
     Keep the post under 1000 words.
     """
-    
+
+def leading_sections(text: str, count: int = None):
+    # The first `count` sections once the next one has started, else None.
+    count = count or IMAGE_SECTIONS
+    for index, match in enumerate(SECTION_BREAK.finditer(text), start=1):
+        if index == count:
+            return text[:match.start()]
+    return None
+
+def stream_blog_post(drug_name: str, drug_details: str, comparison_data: str, bypass_cache: bool = False,
+                     on_opening=None):
+    # Yields the blog text as it is written. on_opening, if given, is called
+    # once with the opening sections as soon as they are complete.
+    parts = []
+    for delta in stream_completion(
+        blog_prompt(drug_name, drug_details, comparison_data),
+        stage='blog_post',
+        bypass_cache=bypass_cache
+    ):
+        parts.append(delta)
+        if on_opening is not None and '\n' in delta:
+            opening = leading_sections(''.join(parts))
+            if opening is not None:
+                on_opening(opening)
+                on_opening = None
+        yield delta
+
+def blog_error_message(drug_name: str) -> str:
+    return f"An error occurred while generating the blog post for {drug_name}. Please try again later."
+
+@traced('generate_blog_post')
+def generate_blog_post(drug_name: str, drug_details: str, comparison_data: str, bypass_cache: bool = False,
+                       on_opening=None):
+    BLOG_PROMPT = blog_prompt(drug_name, drug_details, comparison_data)
+
     try:
-        return get_completion(BLOG_PROMPT, max_tokens=1500)
+        if on_opening is not None:
+            return ''.join(stream_blog_post(
+                drug_name, drug_details, comparison_data, bypass_cache=bypass_cache, on_opening=on_opening
+            ))
+        return get_completion(BLOG_PROMPT, stage='blog_post', bypass_cache=bypass_cache)
     except Exception as e:
         print(f"Error in generate_blog_post: {str(e)}")
-        return f"An error occurred while generating the blog post for {drug_name}. Please try again later."
-
-
-def gen_image(prompt, height=1024, width=1024, num_samples=1):
-    engine_id = "stable-diffusion-v1-6"
-    api_host = 'https://api.stability.ai'
-
-    response = requests.post(
-        f"{api_host}/v1/generation/{engine_id}/text-to-image",
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {STABILITY_API_KEY}"
-        },
-        json={
-            "text_prompts": [
-                {
-                    "text": prompt,
-                }
-            ],
-            "cfg_scale": 7,
-            "height": height,
-            "width": width,
-            "samples": num_samples,
-            "steps": 30,
-        },
-    )
+        return blog_error_message(drug_name)
+
+
+def image_seed(prompt: str) -> int:
+    if IMAGE_SEED:
+        return int(IMAGE_SEED)
+    digest = hashlib.sha256(normalize_query(prompt).encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') % MAX_IMAGE_SEED + 1
 
-    if response.status_code != 200:
-        raise Exception("Non-200 response: " + str(response.text))
+def render_key(engine_id: str, prompt: str, height: int, width: int, steps: int, cfg_scale: float, seed: int,
+               samples: int) -> str:
+    payload = json.dumps([engine_id, normalize_query(prompt), height, width, steps, cfg_scale, seed, samples])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
+def next_variant(key: str, variants):
+    with variant_turns_lock:
+        turn = variant_turns.get(key, 0)
+        variant_turns[key] = turn + 1
+    return variants[turn % len(variants)]
+
+def gen_image(prompt, height=1024, width=1024, num_samples=None, seed=None, bypass_cache: bool = False):
+    num_samples = num_samples or IMAGE_SAMPLES
+    seed = image_seed(prompt) if seed is None else seed
+    key = render_key(STABILITY_ENGINE, prompt, height, width, IMAGE_STEPS, IMAGE_CFG_SCALE, seed, num_samples)
+    with span('gen_image', seed=seed) as attrs:
+        variants = None if bypass_cache else image_cache.get(key)
+        if variants:
+            attrs['cached'] = True
+        else:
+            def generate():
+                generated = _gen_image(prompt, height, width, num_samples, seed)
+                image_cache.set(key, generated)
+                return generated
+            # Requests that need the same render at the same time share one generation.
+            variants, _ = image_flight.do(key, generate)
+        attrs['variants'] = len(variants)
+        return next_variant(key, variants)['base64']
+
+def _gen_image(prompt, height, width, num_samples, seed):
+    engine_id = STABILITY_ENGINE
+    api_host = STABILITY_API_HOST
+
+    def generate(timeout):
+        with service_slots['stability']:
+            response = get_http_session().post(
+                f"{api_host}/v1/generation/{engine_id}/text-to-image",
+                headers={
+                    "Content-Type": "application/json",
+                    "Accept": "application/json",
+                    "Authorization": f"Bearer {api_key('STABILITY_API_KEY')}"
+                },
+                json={
+                    "text_prompts": [
+                        {
+                            "text": prompt,
+                        }
+                    ],
+                    "cfg_scale": IMAGE_CFG_SCALE,
+                    "height": height,
+                    "width": width,
+                    "samples": num_samples,
+                    "steps": IMAGE_STEPS,
+                    "seed": seed,
+                },
+                timeout=timeout
+            )
+        if response.status_code != 200:
+            raise UpstreamError('stability', response.status_code, response.text)
+        return response
+
+    response = call('stability', generate)
     data = response.json()
-    return data['artifacts'][0]['base64']
+    # Filtered or failed samples come back blank; only keep the usable ones.
+    variants = [
+        {'base64': artifact['base64'], 'seed': artifact.get('seed', seed)}
+        for artifact in data['artifacts'] if artifact.get('finishReason', 'SUCCESS') == 'SUCCESS'
+    ]
+    if not variants:
+        reasons = ', '.join(sorted({str(artifact.get('finishReason')) for artifact in data['artifacts']}))
+        raise Exception(f"No usable image artifacts: {reasons}")
+    return variants
 
-def generate_blog_image(drug_name: str, blog_content: str):
+@traced('generate_blog_image')
+def generate_blog_image(drug_name: str, blog_content: str, source: str = "blog post", heading: str = "Blog Content",
+                        bypass_cache: bool = False):
+    blog_content = condense_context('image_prompt', drug_name, [blog_content], IMAGE_CONTEXT_TOKENS)[0]
     IMAGE_PROMPT = f"""
-    Based on the following blog post about {drug_name}, create a prompt for an image that would 
+    Based on the following {source} about {drug_name}, create a prompt for an image that would 
     effectively illustrate the key points of the blog. The image should be informative and 
     visually appealing, suitable for a medical blog. Focus on the drug's primary uses, 
     its comparison with competitors, or a visual representation of its effectiveness.
-    1. Clarity and Concision: The Foundation of Effective Prompts
-Successful AI art generation hinges on crafting clear, precise, and focused prompts. Think of your prompt as a concise creative brief for the AI.
-Key Principles:
+    Write it the way effective AI art prompts are written:
+    - Clear and concise: no ambiguity, every word contributes ("Minimalist landscape, vast desert under a twilight sky").
+    - A detailed subject and scene that sets mood and setting without overloading ("Quiet seaside at dawn, gentle waves, seagulls in distance").
+    - Vivid but coherent context that leaves room for interpretation ("Sunlit forest, towering pines, carpet of fallen autumn leaves").
+    - Compact, high-impact words ("whispering breeze", not "a light wind that can barely be felt but heard").
+    - Optionally an art style, artistic terms (chiaroscuro, bokeh, golden ratio), aspect ratio, camera angle or lighting.
 
-Eliminate ambiguity
-Be brief yet content-rich
-Ensure each word contributes meaningfully
+    {heading}:
+    {blog_content}
 
-Examples:
+    Provide only the image prompt, without any additional explanation or context. DO NOT INCLUDE ANY WORDS INSIDE THE PICTURE.
+    """
+    
+    try:
+        image_prompt = get_completion(IMAGE_PROMPT, stage='image_prompt', bypass_cache=bypass_cache)
+        image_b64 = gen_image(image_prompt, bypass_cache=bypass_cache)
+        with span('deliver_image'):
+            blog_image = deliver_image(image_b64)
+        return blog_image, image_prompt
+    except Exception as e:
+        print(f"Error in generate_blog_image: {str(e)}")
+        return None, f"An error occurred while generating the image prompt for {drug_name}. Please try again later."
 
-"Minimalist landscape, vast desert under a twilight sky"
-"Futuristic cityscape, neon lights, towering skyscrapers"
+def generate_early_blog_image(drug_name: str, drug_details: str, comparison_data: str, bypass_cache: bool = False):
+    # Same image stage, prompted from the blog's inputs instead of the finished post.
+    source_material = f"Drug Details: {drug_details}\n\nComparison Data: {comparison_data}"
+    return generate_blog_image(
+        drug_name,
+        source_material,
+        source="drug details and competitor comparison for an upcoming blog post",
+        heading="Source Material",
+        bypass_cache=bypass_cache
+    )
 
-2. Detailed Subjects and Scenes: Adding Depth to Your Vision
-While maintaining concision, use detailed descriptions to create vivid, immersive scenes. Balance precision with creative freedom for the AI.
-Techniques:
+def generate_opening_blog_image(drug_name: str, opening: str, bypass_cache: bool = False):
+    # Same image stage, prompted from the sections of the post written so far.
+    return generate_blog_image(
+        drug_name, opening, source="opening sections of a blog post", bypass_cache=bypass_cache
+    )
 
-Set mood and atmosphere
-Highlight key aspects
-Define the setting without overwhelming
+def stage_failed(value) -> bool:
+    # Stage functions report failures as placeholder text (or a missing image).
+    if value is None:
+        return True
+    if isinstance(value, (list, tuple)):
+        return any(stage_failed(part) for part in value)
+    return isinstance(value, str) and value.startswith(STAGE_ERROR_PREFIX)
 
-Examples:
+def content_hash(value) -> str:
+    return hashlib.sha256(json.dumps(value).encode('utf-8')).hexdigest()
 
-"Quiet seaside at dawn, gentle waves, seagulls in distance"
-"Ancient forest, moss-covered trees, dappled sunlight through leaves"
+class StageRun:
+    # One request's pass through STAGE_GRAPH. Each stage is looked up by the
+    # hash of its inputs and only computed on a miss; `report` says which
+    # stages were reused, which computed and which fell back on partial or
+    # stand-in data.
+    def __init__(self, drug_name: str, drug_details: str, bypass_cache: bool = False, cache=None):
+        self.values = {'drugName': normalize_query(drug_name), 'drugDetails': " ".join(drug_details.split())}
+        self.bypass_cache = bypass_cache
+        self.cache = stage_cache if cache is None else cache
+        self.report = {}
+        self.inputs = {}
+        # Stages whose output is a stand-in for, or was built around, a failed call.
+        self.fallbacks = set()
+        self.lock = threading.Lock()
 
-3. Contextualizing Prompts: Painting with Words
-Provide rich context without causing confusion. Think of each detail as a brushstroke adding depth to your digital canvas.
-Strategies:
+    def key(self, name: str, inputs=None) -> str:
+        inputs = inputs or STAGE_GRAPH[name]
+        with self.lock:
+            self.inputs[name] = inputs
+            values = [[field, self.values[field]] for field in inputs]
+        models = [completion_route(route)['model'] for route in STAGE_ROUTES.get(name, ())]
+        return content_hash([name, values, models])
 
-Weave vivid yet coherent details
-Allow room for AI interpretation
-Focus on key elements that define the scene
+    def cached(self, name: str, inputs=None):
+        # Returns (key, cached output or None).
+        key = self.key(name, inputs)
+        return key, None if self.bypass_cache else self.cache.get(key)
 
-Example:
-Instead of "a forest," try:
-"Sunlit forest, towering pines, carpet of fallen autumn leaves"
-4. Balancing Detail: Avoiding Prompt Overload
-Strike a balance between descriptive richness and simplicity. Overloading prompts can lead to ambiguous or cluttered results.
-Guidelines:
+    def fell_back(self, name: str):
+        with self.lock:
+            self.fallbacks.add(name)
 
-Be descriptive yet compact
-Choose words that convey the most with the least
-Focus on impactful elements
+    def finish(self, name: str, key: str, value, reused: bool = False):
+        # Failed, empty and stand-in outputs aren't cached, nor is anything
+        # computed from a stand-in, so the next request tries them again.
+        with self.lock:
+            if any(field in self.fallbacks for field in self.inputs.get(name, ())):
+                self.fallbacks.add(name)
+            degraded = name in self.fallbacks
+        if not reused and not degraded and value and not stage_failed(value):
+            self.cache.set(key, value)
+        with self.lock:
+            self.values[name] = content_hash(value)
+            self.report[name] = 'reused' if reused else 'fallback' if degraded else 'computed'
+        return value
 
-Examples:
+    def run(self, name: str, fn, inputs=None):
+        key, value = self.cached(name, inputs)
+        if value is not None:
+            return self.finish(name, key, value, reused=True)
+        return self.finish(name, key, fn())
 
-Instead of "a light wind that can barely be felt but heard," use "whispering breeze"
-"Bustling marketplace at sunset, vibrant stalls, lively crowds"
+    def use(self, field: str, value):
+        # An input that isn't a stage's output, e.g. the opening sections.
+        with self.lock:
+            self.values[field] = content_hash(value)
 
-Pro Tips for Prompt Engineering:
+    def run_competitors(self, drug_name: str):
+        queries = self.run(
+            'queries', lambda: generate_search_queries(
+                drug_name, bypass_cache=self.bypass_cache, on_fallback=lambda: self.fell_back('queries')
+            )
+        )
+        return self.run(
+            'competitors', lambda: find_competitor_drugs(
+                drug_name, bypass_cache=self.bypass_cache, queries=queries,
+                on_fallback=lambda: self.fell_back('competitors')
+            )
+        )
 
-Use Specific Art Styles: Mention particular art styles or artists for distinctive results (e.g., "in the style of Van Gogh")
-Experiment with Text Weights: Use (parentheses) to decrease emphasis or [brackets] to increase emphasis on certain words
-Incorporate Artistic Terms: Use terms like chiaroscuro, bokeh, or golden ratio to guide the AI's artistic approach
-Specify Image Parameters: Include aspect ratios, camera angles, or lighting conditions for more control
+def image_event(blog_image, image_prompt):
+    return {'event': 'image', 'blogImage': blog_image, 'imagePrompt': image_prompt}
 
-    Blog Content:
-    {blog_content}
+def stage_events(drug_name: str, drug_details: str, image_mode: str = None, bypass_cache: bool = False,
+                 cache=None):
+    # The pipeline behind every entry point. Yields one event per stage as it
+    # completes, with the blog text as 'blog_delta' events while the model
+    # writes it; the 'blog' and 'image' events carry the complete values and
+    # 'done' the stage report. `cache` replaces stage_cache (batch runs pass
+    # their checkpoint).
+    image_mode = image_mode or IMAGE_MODE
+    if image_mode not in IMAGE_MODES:
+        raise KeyError(f"'imageMode' must be one of {list(IMAGE_MODES)}")
+    run = StageRun(drug_name, drug_details, bypass_cache=bypass_cache, cache=cache)
 
-    Provide only the image prompt, without any additional explanation or context. DO NOT INCLUDE ANY WORDS INSIDE THE PICTURE.
-    """
-    
+    competitor_info = run.run_competitors(drug_name)
+    logger.info(f"Competitor info: {competitor_info[:500]}...")  # Log first 500 chars
+    yield {'event': 'competitors', 'competitorInfo': competitor_info}
+
+    comparison_data = run.run(
+        'comparison', lambda: compare_drugs(drug_name, drug_details, competitor_info, bypass_cache=bypass_cache)
+    )
+    logger.info(f"Comparison data: {comparison_data[:500]}...")  # Log first 500 chars
+    yield {'event': 'comparison', 'comparison': comparison_data}
+
+    image_futures = []
+    image_result = None
+    if image_mode == 'parallel':
+        image_futures.append(submit(
+            stage_pool, run.run, 'image',
+            lambda: generate_early_blog_image(drug_name, drug_details, comparison_data, bypass_cache=bypass_cache),
+            IMAGE_STAGE_INPUTS['parallel']
+        ))
+    def start_image(opening):
+        run.use('opening', opening)
+        image_futures.append(submit(
+            stage_pool, run.run, 'image',
+            lambda: generate_opening_blog_image(drug_name, opening, bypass_cache=bypass_cache),
+            IMAGE_STAGE_INPUTS['sections']
+        ))
+
+    blog_key, blog_post = run.cached('blog')
+    if blog_post is not None:
+        # Reused: there is nothing to stream, so the whole post is one delta.
+        run.finish('blog', blog_key, blog_post, reused=True)
+        yield {'event': 'blog_delta', 'text': blog_post}
+        if image_mode == 'sections':
+            opening = leading_sections(blog_post)
+            if opening is not None:
+                start_image(opening)
+    else:
+        on_opening = start_image if image_mode == 'sections' else None
+        parts = []
+        try:
+            with span('generate_blog_post'):
+                if STREAM_COMPLETIONS or on_opening is not None:
+                    deltas = stream_blog_post(
+                        drug_name, drug_details, comparison_data, bypass_cache=bypass_cache, on_opening=on_opening
+                    )
+                else:
+                    deltas = [get_completion(
+                        blog_prompt(drug_name, drug_details, comparison_data), stage='blog_post',
+                        bypass_cache=bypass_cache
+                    )]
+                for delta in deltas:
+                    parts.append(delta)
+                    yield {'event': 'blog_delta', 'text': delta}
+                    if image_futures and image_result is None and image_futures[0].done():
+                        image_result = image_futures[0].result()
+                        yield image_event(*image_result)
+            blog_post = ''.join(parts)
+        except Exception as e:
+            print(f"Error in generate_blog_post: {str(e)}")
+            blog_post = blog_error_message(drug_name)
+        run.finish('blog', blog_key, blog_post)
+    logger.info(f"Blog post: {blog_post[:500]}...")  # Log first 500 chars
+    yield {'event': 'blog', 'blogPost': blog_post}
+
+    if image_result is None:
+        if image_futures:
+            image_result = image_futures[0].result()
+        else:
+            # Strict mode, or too few sections to start early: use the whole post.
+            image_result = run.run(
+                'image', lambda: generate_blog_image(drug_name, blog_post, bypass_cache=bypass_cache),
+                IMAGE_STAGE_INPUTS['strict']
+            )
+        yield image_event(*image_result)
+    logger.info(f"Image prompt: {image_result[1]}")
+    logger.info(f"Completion cache: {completion_cache.stats.as_dict()}, image cache: {image_cache.stats.as_dict()}")
+    logger.info(f"Stages: {run.report}, stage cache: {run.cache.stats.as_dict()}")
+    yield {'event': 'done', 'stages': run.report}
+
+def collect_response(artifacts, event):
+    # Folds one stage event into `artifacts`; returns the response fields
+    # gathered so far.
+    if event['event'] != 'blog_delta':
+        artifacts.update({k: v for k, v in event.items() if k != 'event'})
+    return {field: artifacts.get(field) for field in ('blogPost', 'blogImage', 'imagePrompt', 'stages')}
+
+def generate_blog(drug_name: str, drug_details: str, image_mode: str = None, bypass_cache: bool = False,
+                  cache=None):
+    artifacts = {}
+    response_body = None
+    for event in stage_events(drug_name, drug_details, image_mode=image_mode, bypass_cache=bypass_cache, cache=cache):
+        response_body = collect_response(artifacts, event)
+    return response_body
+
+def request_key(drug_name: str, drug_details: str, image_mode: str) -> str:
+    payload = json.dumps([normalize_query(drug_name), " ".join(drug_details.split()), image_mode])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def is_cacheable(response_body) -> bool:
+    if response_body.get('blogImage') is None:
+        return False
+    if 'fallback' in (response_body.get('stages') or {}).values():
+        return False
+    return not any(
+        str(response_body.get(field, '')).startswith(STAGE_ERROR_PREFIX) for field in ('blogPost', 'imagePrompt')
+    )
+
+def reused_stages(response_body):
+    # A cached response reuses every stage it was built from.
+    return {name: 'reused' for name in response_body.get('stages', {})}
+
+def generate_blog_cached(drug_name: str, drug_details: str, image_mode: str = None, bypass_cache: bool = False):
+    image_mode = image_mode or IMAGE_MODE
+    key = request_key(drug_name, drug_details, image_mode)
+    if not bypass_cache:
+        cached = request_cache.get(key)
+        if cached is not None:
+            return {**cached, 'stages': reused_stages(cached)}, 'HIT'
+
+    def generate():
+        response_body = generate_blog(drug_name, drug_details, image_mode=image_mode, bypass_cache=bypass_cache)
+        if is_cacheable(response_body):
+            request_cache.set(key, response_body)
+        return response_body
+
+    response_body, shared = request_flight.do(key, generate)
+    if shared:
+        return response_body, 'COALESCED'
+    return response_body, 'BYPASS' if bypass_cache else 'MISS'
+
+def generate_blog_events(drug_name: str, drug_details: str, image_mode: str = None, bypass_cache: bool = False):
+    # Streaming counterpart of generate_blog_cached: the stage events, served
+    # from and saved to the request cache.
+    image_mode = image_mode or IMAGE_MODE
+    key = request_key(drug_name, drug_details, image_mode)
+    cached = None if bypass_cache else request_cache.get(key)
+    if cached is not None:
+        yield {'event': 'blog', 'blogPost': cached['blogPost']}
+        yield image_event(cached['blogImage'], cached['imagePrompt'])
+        yield {'event': 'done', 'cache': 'HIT', 'stages': reused_stages(cached)}
+        return
+
+    artifacts = {}
+    for event in stage_events(drug_name, drug_details, image_mode=image_mode, bypass_cache=bypass_cache):
+        response_body = collect_response(artifacts, event)
+        if event['event'] == 'done':
+            if is_cacheable(response_body):
+                request_cache.set(key, response_body)
+            event = {**event, 'cache': 'BYPASS' if bypass_cache else 'MISS'}
+        yield event
+
+def submit_job(drug_name: str, drug_details: str, image_mode: str = None, bypass_cache: bool = False):
+    image_mode = image_mode or IMAGE_MODE
+    if image_mode not in IMAGE_MODES:
+        raise KeyError(f"'imageMode' must be one of {list(IMAGE_MODES)}")
+    if JOB_RUNNER == 'lambda' and not job_store.shared:
+        raise RuntimeError(JOB_STORE_ERROR)
+    job = new_job({
+        'drugName': drug_name,
+        'drugDetails': drug_details,
+        'imageMode': image_mode,
+        'bypassCache': bypass_cache
+    })
+    job_store.put(job)
+    dispatch_job(job['jobId'])
+    return job
+
+def dispatch_job(job_id: str):
+    if JOB_RUNNER == 'lambda':
+        import boto3  # provided by the Lambda runtime
+        boto3.client('lambda').invoke(
+            FunctionName=os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+            InvocationType='Event',
+            Payload=json.dumps({'action': 'runJob', 'jobId': job_id})
+        )
+    else:
+        submit(job_pool, run_job, job_id)
+
+def log_trace(trace, **fields):
+    summary = trace.summary(include_spans=False)
+    logger.info(json.dumps({'type': 'request_trace', **fields, **summary}))
+    return summary
+
+def mark_running(job, stages):
+    for stage in stages:
+        if job['stages'][stage]['status'] == 'pending':
+            job['stages'][stage] = {'status': 'running', 'startedAt': time()}
+
+def run_job(job_id: str):
+    job = job_store.get(job_id)
+    if job is None or job['status'] != 'queued':
+        logger.info(f"Skipping job {job_id}: {'not found' if job is None else job['status']}")
+        return
+    request = job['request']
+    # Which stages start once a given stage has reported.
+    next_stages = {
+        'competitors': ['comparison'],
+        'comparison': ['blog', 'image'] if request['imageMode'] in ('parallel', 'sections') else ['blog'],
+        'blog': ['image']
+    }
+    job['status'] = 'running'
+    mark_running(job, ['competitors'])
+    job_store.put(job)
+
+    with trace_request('job') as trace:
+        execute_job(job, next_stages)
+    log_trace(trace, jobId=job_id, drugName=request['drugName'], status=job['status'])
+
+def execute_job(job, next_stages):
+    job_id = job['jobId']
+    request = job['request']
     try:
-        image_prompt = get_completion(IMAGE_PROMPT, max_tokens=100)
-        blog_image_b64 = gen_image(image_prompt)
-        return blog_image_b64, image_prompt
+        for event in generate_blog_events(
+            request['drugName'],
+            request['drugDetails'],
+            image_mode=request['imageMode'],
+            bypass_cache=request['bypassCache']
+        ):
+            stage = event['event']
+            if stage == 'blog_delta':
+                continue
+            if stage == 'done':
+                # A response from the request cache replays only the blog and
+                # image events; every stage was served from it alike.
+                for stage_name, record in job['stages'].items():
+                    if event.get('cache') == 'HIT' or record['status'] != 'done':
+                        job['stages'][stage_name] = {'status': 'cached'}
+                    elif event['stages'].get(stage_name) == 'reused':
+                        record['reused'] = True
+                job['status'] = 'succeeded'
+            else:
+                started_at = job['stages'][stage].get('startedAt')
+                job['stages'][stage] = {'status': 'done', 'startedAt': started_at, 'completedAt': time()}
+                job['artifacts'].update({k: v for k, v in event.items() if k != 'event'})
+                mark_running(job, next_stages.get(stage, []))
+            job_store.put(job)
     except Exception as e:
-        print(f"Error in generate_blog_image: {str(e)}")
-        return None, f"An error occurred while generating the image prompt for {drug_name}. Please try again later."
+        logger.error(f"Job {job_id} failed: {str(e)}", exc_info=True)
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        job_store.put(job)
+
+def job_summary(job):
+    return {
+        'jobId': job['jobId'],
+        'status': job['status'],
+        'stages': job['stages'],
+        'error': job['error'],
+        'createdAt': job['createdAt'],
+        'updatedAt': job['updatedAt']
+    }
+
+def job_response(status_code: int, payload):
+    return {
+        'statusCode': status_code,
+        'body': json.dumps(payload),
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': 'https://medbloggen.xyz',
+            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
+            'Access-Control-Allow-Methods': 'POST,OPTIONS'
+        }
+    }
+
+def handle_job_action(action: str, body):
+    if action == 'submit':
+        if 'drugName' not in body or 'drugDetails' not in body:
+            raise KeyError("'drugName' or 'drugDetails' not found in body")
+        job = submit_job(
+            body['drugName'],
+            body['drugDetails'],
+            image_mode=body.get('imageMode'),
+            bypass_cache=bool(body.get('bypassCache', False))
+        )
+        logger.info(f"Submitted job {job['jobId']} for drug: {body['drugName']}")
+        return job_response(202, job_summary(job))
+
+    if 'jobId' not in body:
+        raise KeyError("'jobId' not found in body")
+    job = job_store.get(body['jobId'])
+    if job is None:
+        return job_response(404, {'error': f"Job {body['jobId']} not found"})
+    if action == 'status' or job['status'] in ('queued', 'running'):
+        return job_response(200 if action == 'status' else 202, job_summary(job))
+    if job['status'] == 'failed':
+        return job_response(500, job_summary(job))
+    artifacts = job['artifacts']
+    return job_response(200, {
+        'jobId': job['jobId'],
+        'blogPost': artifacts.get('blogPost'),
+        'blogImage': artifacts.get('blogImage'),
+        'imagePrompt': artifacts.get('imagePrompt')
+    })
+
+def request_deadline(context):
+    seconds = REQUEST_DEADLINE or None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        lambda_left = context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+        seconds = lambda_left if seconds is None else min(seconds, lambda_left)
+    return seconds
+
+def loggable(response_body):
+    # The image can be hundreds of KB even re-encoded; log its size instead.
+    image = response_body.get('blogImage')
+    if image and image.startswith('data:'):
+        return {**response_body, 'blogImage': f"{image[:image.index(',') + 1]}<{len(image)} chars>"}
+    return response_body
+
+def image_response(name: str, headers):
+    # GET /images/<name>: stored images, as binary through API Gateway.
+    etag = image_etag(name)
+    cache_headers = {'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if (headers or {}).get('if-none-match') == etag:
+        return {'statusCode': 304, 'body': '', 'headers': cache_headers}
+    blob = get_blob_store().get(name)
+    if blob is None:
+        return job_response(404, {'error': f"Image {name} not found"})
+    data, content_type = blob
+    return {
+        'statusCode': 200,
+        'isBase64Encoded': True,
+        'body': base64.b64encode(data).decode('ascii'),
+        'headers': {**cache_headers, 'Content-Type': content_type, 'Access-Control-Allow-Origin': 'https://medbloggen.xyz'}
+    }
+
+def request_path(event) -> str:
+    # REST APIs pass the resource path; HTTP APIs pass rawPath, which keeps
+    # the stage prefix (/prod/images/...) unless the stage is $default.
+    path = event.get('rawPath') or event.get('path') or ''
+    stage = (event.get('requestContext') or {}).get('stage')
+    if event.get('rawPath') and stage and stage != '$default' and path.startswith(f"/{stage}/"):
+        path = path[len(stage) + 1:]
+    return path
 
 def lambda_handler(event, context):
     try:
+        path = request_path(event)
+        if path.startswith('/images/'):
+            headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+            return image_response(path[len('/images/'):], headers)
+
         logger.info(f"Received event: {json.dumps(event)}")
+
+        if event.get('action') == 'runJob':
+            with deadline_scope(request_deadline(context)):
+                run_job(event['jobId'])
+            return {'statusCode': 200, 'body': json.dumps({'jobId': event['jobId']})}
         
         if 'body' not in event:
             raise KeyError("'body' not found in event")
@@ -292,6 +1377,14 @@ def lambda_handler(event, context):
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse body as JSON: {str(e)}")
             raise
+        if not isinstance(body, dict):
+            raise KeyError("Request body must be a JSON object")
+
+        action = body.get('action', 'generate')
+        if action in JOB_ACTIONS:
+            return handle_job_action(action, body)
+        if action != 'generate':
+            raise KeyError(f"Unknown action: {action}")
         
         if 'drugName' not in body or 'drugDetails' not in body:
             raise KeyError("'drugName' or 'drugDetails' not found in body")
@@ -300,26 +1393,24 @@ def lambda_handler(event, context):
         drug_details = body['drugDetails']
 
         logger.info(f"Processing request for drug: {drug_name}")
-        
-        competitor_info = find_competitor_drugs(drug_name)
-        logger.info(f"Competitor info: {competitor_info[:500]}...")  # Log first 500 chars
-        
-        comparison_data = compare_drugs(drug_name, drug_details, competitor_info)
-        logger.info(f"Comparison data: {comparison_data[:500]}...")  # Log first 500 chars
-        
-        blog_post = generate_blog_post(drug_name, drug_details, comparison_data)
-        logger.info(f"Blog post: {blog_post[:500]}...")  # Log first 500 chars
-        
-        blog_image_b64, image_prompt = generate_blog_image(drug_name, blog_post)
-        logger.info(f"Image prompt: {image_prompt}")
 
-        response_body = {
-            'blogPost': blog_post,
-            'blogImage': blog_image_b64,
-            'imagePrompt': image_prompt
-        }
+        with trace_request() as trace, deadline_scope(request_deadline(context)):
+            response_body, cache_status = generate_blog_cached(
+                drug_name,
+                drug_details,
+                image_mode=body.get('imageMode'),
+                bypass_cache=bool(body.get('bypassCache', False))
+            )
+        summary = log_trace(trace, drugName=drug_name, cache=cache_status)
+        if body.get('timings', INCLUDE_TIMINGS):
+            summary['spans'] = trace.summary()['spans']
+            response_body = {**response_body, 'timings': summary}
 
-        logger.info(f"Response body: {json.dumps(response_body, indent=2)}")
+        logger.info(f"Response body: {json.dumps(loggable(response_body), indent=2)}")
+        logger.info(f"HTTP pool stats: {json.dumps(http_pool_stats())}")
+        if breaker_states():
+            logger.warning(f"Open circuit breakers: {json.dumps(breaker_states())}")
+        logger.info(f"Request cache: {cache_status} {request_cache.stats.as_dict()}")
 
         return {
             'statusCode': 200,
@@ -328,7 +1419,9 @@ def lambda_handler(event, context):
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': 'https://medbloggen.xyz',
                 'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-                'Access-Control-Allow-Methods': 'POST,OPTIONS'
+                'Access-Control-Allow-Methods': 'POST,OPTIONS',
+                'Access-Control-Expose-Headers': 'X-Cache',
+                'X-Cache': cache_status
             }
         }
     except KeyError as e:
@@ -360,4 +1453,16 @@ def lambda_handler(event, context):
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': 'https://medbloggen.xyz'
             }
-        }
\ No newline at end of file
+        }
+
+
+def warm_up():
+    try:
+        get_http_session()
+        get_client()
+    except KeyError as e:
+        logger.warning(f"Skipping eager client initialization: {str(e)}")
+
+
+if not LAZY_INIT:
+    warm_up()
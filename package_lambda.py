@@ -1,37 +1,206 @@
 #!/usr/bin/env python3
 
+import ast
+import compileall
+import json
 import os
+import py_compile
+import re
 import zipfile
 import shutil
 
+# PACKAGE_MODE=closure (default) ships only the installed distributions the
+# function imports, plus their requirements; PACKAGE_MODE=full copies the whole
+# site-packages tree as before. PACKAGE_PRECOMPILE=true ships bytecode, which
+# saves compiling every module on each cold start since /var/task is read-only.
+PACKAGE_ROOT = os.environ.get('PACKAGE_ROOT', '/var/task')
+PACKAGE_MODE = os.environ.get('PACKAGE_MODE', 'closure')
+PACKAGE_PRECOMPILE = os.environ.get('PACKAGE_PRECOMPILE', 'false').lower() in ('1', 'true', 'yes')
+SITE_PACKAGES = os.environ.get('SITE_PACKAGES', '/var/lang/lib/python3.9/site-packages')
+# Provided by the Lambda runtime, so never bundled.
+PACKAGE_EXCLUDE = {
+    name.strip().lower() for name in os.environ.get('PACKAGE_EXCLUDE', 'boto3,botocore,s3transfer').split(',')
+    if name.strip()
+}
+# Directories and files that are never imported at runtime.
+SKIP_DIRS = {'__pycache__', 'tests', 'test', 'docs', 'doc', 'examples'}
+SKIP_SUFFIXES = ('.pyc', '.pyo', '.pyi', '.md', '.rst')
+
 # Ensure we're in the /var/task directory
-os.chdir('/var/task')
+os.chdir(PACKAGE_ROOT)
 
 # Create a temporary directory
 tmp_package = 'tmp_package'
 os.makedirs(tmp_package, exist_ok=True)
 
-# Copy the Lambda function code
-shutil.copy('lambda_function.py', tmp_package)
+# Copy the Lambda function code: lambda_function.py and every local module it
+# imports, directly or through other local modules. Imports inside functions
+# count too, since some modules are only loaded on first use. Servers, batch
+# and benchmark scripts are never imported by the function and stay out.
+def imported_names(path):
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield alias.name.split('.')[0]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            yield node.module.split('.')[0]
+
+
+def local_imports(module, found=None, external=None):
+    found = set() if found is None else found
+    path = f"{module}.py"
+    if path in found:
+        return found
+    if not os.path.isfile(path):
+        if external is not None:
+            external.add(module)
+        return found
+    found.add(path)
+    for name in imported_names(path):
+        local_imports(name, found, external)
+    return found
+
+
+external_imports = set()
+FUNCTION_MODULES = sorted(local_imports('lambda_function', external=external_imports))
+print(f"Function modules: {', '.join(FUNCTION_MODULES)}")
+for module in FUNCTION_MODULES:
+    shutil.copy(module, tmp_package)
+
+
+# Installed distributions, read from their dist-info: the files each one
+# installed (RECORD), the top-level names it provides and what it requires.
+def canonical(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def read_distributions(site_packages):
+    distributions = {}
+    for entry in os.listdir(site_packages):
+        if not entry.endswith('.dist-info'):
+            continue
+        dist_info = os.path.join(site_packages, entry)
+        record_path = os.path.join(dist_info, 'RECORD')
+        metadata_path = os.path.join(dist_info, 'METADATA')
+        if not os.path.isfile(record_path) or not os.path.isfile(metadata_path):
+            continue
+        name, requires = None, []
+        with open(metadata_path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip():
+                    break
+                if line.startswith('Name:'):
+                    name = line[len('Name:'):].strip()
+                elif line.startswith('Requires-Dist:'):
+                    requirement = line[len('Requires-Dist:'):].strip()
+                    # Requirements that only come with an extra aren't needed.
+                    if 'extra ==' not in requirement:
+                        requires.append(canonical(re.match(r'[A-Za-z0-9._-]+', requirement).group(0)))
+        with open(record_path, encoding='utf-8') as f:
+            files = [line.rsplit(',', 2)[0] for line in f if line.strip()]
+        files = [path for path in files if not path.startswith('..') and not os.path.isabs(path)]
+        top_level = {
+            path.split('/')[0].split('.')[0] for path in files
+            if not path.split('/')[0].endswith(('.dist-info', '.data'))
+        }
+        distributions[canonical(name or entry.split('-')[0])] = {
+            'name': name, 'files': files, 'topLevel': top_level, 'requires': requires
+        }
+    return distributions
+
+
+def dependency_closure(distributions, imports):
+    providers = {}
+    for key, distribution in distributions.items():
+        for top_level in distribution['topLevel']:
+            providers.setdefault(top_level, key)
+    pending = sorted({providers[name] for name in imports if name in providers})
+    needed = set()
+    while pending:
+        key = pending.pop()
+        if key in needed or key not in distributions or key in PACKAGE_EXCLUDE:
+            continue
+        needed.add(key)
+        pending.extend(distributions[key]['requires'])
+    return needed
+
+
+def source_of(path):
+    # pycs land in <dir>/__pycache__/<module>.cpython-39.pyc next to the source.
+    directory, _, name = path.rpartition('/')
+    if directory.rpartition('/')[2] != '__pycache__':
+        return path
+    parent = directory[:-len('__pycache__')].rstrip('/')
+    return f"{parent}/{name.split('.')[0]}.py".lstrip('/')
+
+
+def skipped(path):
+    parts = path.split('/')
+    return any(part in SKIP_DIRS for part in parts[:-1]) or parts[-1].endswith(SKIP_SUFFIXES)
+
 
 # Copy installed dependencies
-site_packages = '/var/lang/lib/python3.9/site-packages'
-for item in os.listdir(site_packages):
-    s = os.path.join(site_packages, item)
-    d = os.path.join(tmp_package, item)
-    if os.path.isdir(s):
-        shutil.copytree(s, d, symlinks=False, ignore=None)
-    else:
-        shutil.copy2(s, d)
+site_packages = SITE_PACKAGES
+sizes = {}
+if PACKAGE_MODE == 'full':
+    for item in os.listdir(site_packages):
+        s = os.path.join(site_packages, item)
+        d = os.path.join(tmp_package, item)
+        if os.path.isdir(s):
+            shutil.copytree(s, d, symlinks=False, ignore=None)
+        else:
+            shutil.copy2(s, d)
+else:
+    distributions = read_distributions(site_packages)
+    needed = dependency_closure(distributions, external_imports)
+    print(f"Dependencies: {', '.join(distributions[key]['name'] for key in sorted(needed))}")
+    for key in sorted(needed):
+        for path in distributions[key]['files']:
+            source = os.path.join(site_packages, path)
+            if skipped(path) or not os.path.isfile(source):
+                continue
+            destination = os.path.join(tmp_package, path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copy2(source, destination)
+            sizes[path] = distributions[key]['name']
+
+if PACKAGE_PRECOMPILE:
+    # Unchecked-hash pycs are used as-is, without comparing against the source
+    # mtime (which the zip doesn't preserve exactly). Build with the same
+    # Python version as the Lambda runtime.
+    compileall.compile_dir(
+        tmp_package, quiet=1, optimize=0, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH
+    )
 
 # Create a ZIP file
+report = {}
 with zipfile.ZipFile('lambda_function.zip', 'w', zipfile.ZIP_DEFLATED) as zipf:
     for root, _, files in os.walk(tmp_package):
         for file in files:
             zipf.write(os.path.join(root, file),
                        os.path.relpath(os.path.join(root, file), tmp_package))
+    for info in zipf.infolist():
+        source = source_of(info.filename)
+        owner = sizes.get(source) or ('function' if '/' not in source else source.split('/')[0])
+        entry = report.setdefault(owner, {'files': 0, 'bytes': 0, 'compressedBytes': 0})
+        entry['files'] += 1
+        entry['bytes'] += info.file_size
+        entry['compressedBytes'] += info.compress_size
 
 # Clean up
 shutil.rmtree(tmp_package)
 
-print("Lambda function packaged as lambda_function.zip")
\ No newline at end of file
+# Size report, largest first
+report = dict(sorted(report.items(), key=lambda item: item[1]['compressedBytes'], reverse=True))
+with open('lambda_function.report.json', 'w') as f:
+    json.dump({'mode': PACKAGE_MODE, 'precompiled': PACKAGE_PRECOMPILE, 'packages': report}, f, indent=2)
+print(f"{'package':<32}{'files':>8}{'unzipped KB':>14}{'zipped KB':>12}")
+for owner, entry in report.items():
+    print(f"{owner:<32}{entry['files']:>8}{entry['bytes'] / 1024:>14.1f}{entry['compressedBytes'] / 1024:>12.1f}")
+print(f"{'total':<32}{sum(e['files'] for e in report.values()):>8}"
+      f"{sum(e['bytes'] for e in report.values()) / 1024:>14.1f}"
+      f"{os.path.getsize('lambda_function.zip') / 1024:>12.1f}")
+
+print("Lambda function packaged as lambda_function.zip")
@@ -0,0 +1,133 @@
+import os
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Ranking of web search hits before any page is fetched: duplicate URLs are
+# merged, each domain contributes at most RANKING_PER_DOMAIN pages, and the
+# rest are ordered by how well their title and snippet match the drug, with a
+# bonus for domains on the trusted allowlist. Hits that don't mention the drug
+# at all, and documents the page extractor can't read, are only used when
+# nothing better is left.
+TRUSTED_DOMAINS = {
+    domain.strip().lower() for domain in os.environ.get(
+        'TRUSTED_DOMAINS',
+        'nih.gov,medlineplus.gov,fda.gov,cdc.gov,who.int,nhs.uk,ema.europa.eu,mayoclinic.org,'
+        'clevelandclinic.org,drugs.com,rxlist.com,medscape.com,webmd.com,healthline.com'
+    ).split(',') if domain.strip()
+}
+RANKING_PER_DOMAIN = int(os.environ.get('RANKING_PER_DOMAIN', '1'))
+
+# Matched exactly, except for the utm_ family, so ?referenceDrug=... survives.
+TRACKING_PARAMS = {'gclid', 'fbclid', 'mc_cid', 'mc_eid', 'ref', 'ref_src'}
+TRACKING_PREFIXES = ('utm_',)
+# Second-level labels under which registrations happen one level deeper
+# (www.nhs.uk -> nhs.uk, but www.example.co.uk -> example.co.uk).
+SECOND_LEVEL_LABELS = {'co', 'com', 'org', 'net', 'gov', 'ac', 'edu'}
+INTENT_TERMS = {'alternative', 'alternatives', 'vs', 'versus', 'compare', 'comparison', 'similar', 'competitor',
+                'competitors', 'instead', 'switch', 'substitute', 'options'}
+SKIP_EXTENSIONS = ('.pdf', '.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx', '.zip')
+
+TAG_PATTERN = re.compile(r'<[^>]+>')
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def is_tracking_param(name: str) -> bool:
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def normalize_url(url: str) -> str:
+    # Key for "same page": scheme, www., fragment, default ports, trailing
+    # slashes, tracking parameters and query order don't matter.
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not is_tracking_param(name)
+    )
+    return urlunsplit(('', host, parts.path.rstrip('/') or '/', urlencode(query), ''))
+
+
+def site_domain(url: str) -> str:
+    labels = (urlsplit(url).hostname or '').lower().split('.')
+    if len(labels) >= 3 and labels[-2] in SECOND_LEVEL_LABELS and len(labels[-1]) == 2:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def is_trusted(domain: str, trusted=None) -> bool:
+    trusted = TRUSTED_DOMAINS if trusted is None else trusted
+    labels = domain.split('.')
+    # Subdomains of an allowlisted domain count (ncbi.nlm.nih.gov -> nih.gov).
+    return any('.'.join(labels[i:]) in trusted for i in range(len(labels)))
+
+
+def words(text: str):
+    return WORD_PATTERN.findall(TAG_PATTERN.sub(' ', text or '').lower())
+
+
+def is_relevant(result, drug_name: str) -> bool:
+    if urlsplit(result['url']).path.lower().endswith(SKIP_EXTENSIONS):
+        return False
+    name_words = set(words(drug_name))
+    return bool(name_words & set(words(result.get('title')) + words(result.get('description'))))
+
+
+def score_result(result, drug_name: str, trusted=None) -> float:
+    name_words = set(words(drug_name))
+    title = set(words(result.get('title')))
+    snippet = set(words(result.get('description')))
+    score = 0.0
+    if name_words:
+        score += 2.0 * len(name_words & title) / len(name_words)
+        score += 1.0 * len(name_words & snippet) / len(name_words)
+    score += 0.5 * min(3, len(INTENT_TERMS & (title | snippet)))
+    if is_trusted(site_domain(result['url']), trusted):
+        score += 2.0
+    # Pages several queries agree on, and those the engine ranked highly.
+    score += 0.5 * (result['_queries'] - 1)
+    score += 1.0 / (1 + result['_position'])
+    return score
+
+
+def rank_results(result_lists, drug_name: str, limit: int, per_domain: int = None, trusted=None):
+    # result_lists holds one list of search hits per query. Returns at most
+    # `limit` hits, best first, each annotated with its '_score'.
+    per_domain = RANKING_PER_DOMAIN if per_domain is None else per_domain
+    candidates = {}
+    for results in result_lists:
+        for position, result in enumerate(results or []):
+            url = result.get('url')
+            if not url:
+                continue
+            key = normalize_url(url)
+            if key in candidates:
+                seen = candidates[key]
+                seen['_queries'] += 1
+                seen['_position'] = min(seen['_position'], position)
+            else:
+                candidates[key] = {**result, '_queries': 1, '_position': position}
+
+    for candidate in candidates.values():
+        candidate['_score'] = score_result(candidate, drug_name, trusted)
+    ranked = sorted(candidates.values(), key=lambda candidate: candidate['_score'], reverse=True)
+
+    selected = []
+    overflow = []
+    unrelated = []
+    per_site = {}
+    for candidate in ranked:
+        domain = site_domain(candidate['url'])
+        if not is_relevant(candidate, drug_name):
+            unrelated.append(candidate)
+        elif per_site.get(domain, 0) >= per_domain:
+            overflow.append(candidate)
+        else:
+            per_site[domain] = per_site.get(domain, 0) + 1
+            selected.append(candidate)
+    # Too few distinct domains: fill the remaining slots with the best of the rest.
+    return (selected + overflow + unrelated)[:limit]
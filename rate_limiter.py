@@ -0,0 +1,64 @@
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import monotonic, sleep
+
+
+# Thread-safe token bucket: `rate` tokens per second, up to `burst` banked.
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self, tokens: float = 1, timeout: float = None) -> bool:
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self.lock:
+                now = monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait = max(self.blocked_until - now, (tokens - self.tokens) / self.rate)
+            if deadline is not None:
+                if monotonic() + wait > deadline:
+                    return False
+            sleep(wait)
+
+    def pause(self, seconds: float):
+        # Called when the upstream says we are over quota (e.g. 429 + Retry-After):
+        # one token is released when the window has passed and the rest of the
+        # bank only starts refilling from then on.
+        with self.lock:
+            now = monotonic()
+            self._refill(now)
+            self.tokens = 1.0
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.updated = self.blocked_until
+
+
+def parse_retry_after(value, default: float = 1.0) -> float:
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
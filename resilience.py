@@ -0,0 +1,355 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+from tracing import span, submit
+
+logger = logging.getLogger()
+
+
+def env_overrides(name: str):
+    # Per-key overrides given as a JSON object of objects in env var `name`. A
+    # malformed value is logged and ignored rather than failing the import.
+    raw = os.environ.get(name, '')
+    if not raw.strip():
+        return {}
+    try:
+        overrides = json.loads(raw)
+        if not isinstance(overrides, dict) or not all(isinstance(value, dict) for value in overrides.values()):
+            raise ValueError("expected a JSON object of objects")
+    except ValueError as e:
+        logger.error(f"Ignoring {name}, using the defaults: {str(e)}")
+        return {}
+    return overrides
+
+
+# Every outbound call (Anthropic, Brave, Stability, result pages) goes through
+# call(). Each attempt gets the dependency's timeout, capped by what is left of
+# the request deadline; failures that may be transient are retried with
+# full-jitter exponential backoff while time remains; and each dependency (or
+# model, or page host) has a circuit breaker that fails fast after repeated
+# failures instead of letting every request wait out the timeout. Deadlines
+# live in a context variable, so work handed to pools with tracing.submit
+# inherits the deadline of the request that started it.
+#
+# DEPENDENCY_POLICIES can be overridden per dependency with a JSON env var,
+# e.g. '{"pages": {"hedgeAfter": 0}}' turns off hedged page fetches.
+DEPENDENCY_POLICIES = {
+    'anthropic': {'timeout': 120, 'retries': 1, 'backoff': 0.5, 'maxBackoff': 8, 'failures': 5, 'reset': 30},
+    'brave': {'timeout': 10, 'retries': 2, 'backoff': 0.5, 'maxBackoff': 4, 'failures': 5, 'reset': 30},
+    'stability': {'timeout': 60, 'retries': 1, 'backoff': 1, 'maxBackoff': 8, 'failures': 3, 'reset': 60},
+    # Pages aren't retried: a fetch still running hedgeAfter seconds after it
+    # started gets a duplicate instead, and whichever answers first is used.
+    # Each fetch earns hedgeBudget of a hedge (banking up to hedgeBurst), so
+    # hedges stay a small share of fetches even when every fetch is slow.
+    'pages': {'timeout': 10, 'retries': 0, 'backoff': 0.25, 'maxBackoff': 1, 'failures': 3, 'reset': 60,
+              'hedgeAfter': 1.5, 'hedgeBudget': 0.1, 'hedgeBurst': 3},
+}
+for _name, _overrides in env_overrides('DEPENDENCY_POLICIES').items():
+    DEPENDENCY_POLICIES[_name] = {**DEPENDENCY_POLICIES.get(_name, {}), **_overrides}
+HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', '8'))
+# Statuses worth another attempt: timeouts, rate limits and server errors.
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504, 529}
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedge')
+# Hedge pool threads currently running an attempt.
+_hedge_busy = 0
+_hedge_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class UpstreamError(Exception):
+    def __init__(self, dependency: str, status: int, message: str = '', retry_after: float = None):
+        super().__init__(f"{dependency} returned HTTP {status}" + (f": {message[:200]}" if message else ''))
+        self.dependency = dependency
+        self.status = status
+        self.retry_after = retry_after
+
+
+@contextmanager
+def deadline_scope(seconds: float = None):
+    # Nested scopes can only shorten the deadline; None leaves it as it is.
+    current = _deadline.get()
+    if seconds is None:
+        yield current
+        return
+    deadline = monotonic() + seconds
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def time_left():
+    # Seconds until the current deadline, or None without one.
+    deadline = _deadline.get()
+    return None if deadline is None else max(0.0, deadline - monotonic())
+
+
+def check_deadline(what: str):
+    if time_left() == 0:
+        raise DeadlineExceeded(f"{what}: request deadline exceeded")
+
+
+def until_deadline(chunks):
+    # Stops a streamed download when the deadline passes; the caller keeps
+    # whatever arrived.
+    for chunk in chunks:
+        yield chunk
+        if time_left() == 0:
+            return
+
+
+class CircuitBreaker:
+    # Closed until `failures` consecutive failures, then open (calls fail
+    # immediately) for `reset` seconds, then half-open: one probe call goes
+    # through and its outcome closes or re-opens the breaker.
+    def __init__(self, name: str, failures: int = 5, reset: float = 30):
+        self.name = name
+        self.threshold = failures
+        self.reset = reset
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == 'open' and monotonic() - self.opened_at >= self.reset:
+                self.state = 'half_open'
+                self.probing = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self.opened_at = monotonic()
+            self.probing = False
+
+    def release(self):
+        # The call ended without saying anything about the dependency's health.
+        with self.lock:
+            self.probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(dependency: str, key: str = None) -> CircuitBreaker:
+    name = f"{dependency}:{key}" if key else dependency
+    with _breakers_lock:
+        if name not in _breakers:
+            policy = DEPENDENCY_POLICIES[dependency]
+            _breakers[name] = CircuitBreaker(name, policy['failures'], policy['reset'])
+        return _breakers[name]
+
+
+def breaker_states():
+    # Only the breakers that aren't closed, e.g. for a log line.
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: {'state': b.state, 'failures': b.failures} for b in breakers if b.state != 'closed'}
+
+
+def is_retryable(e) -> bool:
+    if isinstance(e, UpstreamError):
+        return e.status in RETRY_STATUSES
+    # Connection errors and timeouts (requests' exceptions are OSErrors too);
+    # invalid URLs and the like are ValueErrors as well and never retried.
+    return isinstance(e, OSError) and not isinstance(e, ValueError)
+
+
+def is_rate_limited(e) -> bool:
+    # A 429 says we're over quota, not that the dependency is unhealthy.
+    return isinstance(e, UpstreamError) and e.status == 429
+
+
+def backoff_delay(policy, attempt: int, e) -> float:
+    delay = random.uniform(0, min(policy['maxBackoff'], policy['backoff'] * 2 ** attempt))
+    return max(delay, getattr(e, 'retry_after', None) or 0)
+
+
+def call(dependency: str, fn, key: str = None, timeout: float = None, retries: int = None, is_failure=None,
+         is_throttled=None):
+    # fn(timeout) makes one attempt; `timeout` and `retries` default to the
+    # dependency's policy. is_failure decides which errors count against the
+    # breaker and are retried (default: is_retryable); is_throttled picks
+    # errors that are retried without counting against it (e.g. is_rate_limited).
+    policy = DEPENDENCY_POLICIES[dependency]
+    timeout = timeout or policy['timeout']
+    retries = policy['retries'] if retries is None else retries
+    is_failure = is_failure or is_retryable
+    circuit = breaker(dependency, key)
+    with span('upstream', dependency=dependency) as attrs:
+        for attempt in range(retries + 1):
+            check_deadline(dependency)
+            if not circuit.allow():
+                attrs['circuitOpen'] = True
+                raise CircuitOpen(f"{circuit.name}: circuit open")
+            attrs['attempts'] = attempt + 1
+            left = time_left()
+            capped = left is not None and left < timeout
+            try:
+                result = fn(timeout if left is None else min(timeout, left))
+            except Exception as e:
+                if capped and time_left() == 0:
+                    # Cut short by our own deadline; says nothing about the dependency.
+                    circuit.release()
+                    raise DeadlineExceeded(f"{dependency}: request deadline exceeded") from e
+                throttled = is_throttled is not None and is_throttled(e)
+                if not throttled and not is_failure(e):
+                    circuit.release()
+                    raise
+                if throttled:
+                    circuit.release()
+                else:
+                    circuit.record_failure()
+                delay = backoff_delay(policy, attempt, e)
+                left = time_left()
+                if attempt == retries or (left is not None and delay >= left):
+                    raise
+                print(f"{dependency} attempt {attempt + 1} failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                sleep(delay)
+            else:
+                circuit.record_success()
+                return result
+
+
+class HedgeBudget:
+    # Each hedgeable call earns `ratio` of a hedge, up to `burst` banked, and
+    # each hedge spends a whole one.
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.lock = threading.Lock()
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+_hedge_budgets = {}
+
+
+def hedge_budget(dependency: str) -> HedgeBudget:
+    with _hedge_lock:
+        if dependency not in _hedge_budgets:
+            policy = DEPENDENCY_POLICIES[dependency]
+            _hedge_budgets[dependency] = HedgeBudget(policy.get('hedgeBudget', 0.1), policy.get('hedgeBurst', 3))
+        return _hedge_budgets[dependency]
+
+
+def hedge_attempt(fn, started=None, slot=None):
+    # Wraps fn for the hedge pool: counts it as busy while it runs, puts its
+    # start time on the `started` queue and releases `slot` when it is done.
+    def attempt():
+        global _hedge_busy
+        with _hedge_lock:
+            _hedge_busy += 1
+        if started is not None:
+            started.put(monotonic())
+        try:
+            return fn()
+        finally:
+            with _hedge_lock:
+                _hedge_busy -= 1
+            if slot is not None:
+                slot.release()
+    return attempt
+
+
+def can_hedge(dependency: str, slot=None) -> bool:
+    # Only with an idle hedge thread, a free `slot` (taken here on success)
+    # and budget left, so hedging never adds load when the process is busy.
+    with _hedge_lock:
+        if _hedge_busy >= HEDGE_WORKERS:
+            return False
+    if slot is not None and not slot.acquire(blocking=False):
+        return False
+    if hedge_budget(dependency).spend():
+        return True
+    if slot is not None:
+        slot.release()
+    return False
+
+
+def hedged(dependency: str, fn, after: float = None, slot=None):
+    # Runs fn(); if it is still running `after` seconds (the policy's
+    # hedgeAfter) after it started, starts one duplicate when can_hedge allows
+    # and returns whichever succeeds first. The slower copy is left to finish
+    # on its own, bounded by its timeout. `slot` is a semaphore the caller
+    # holds for the first attempt (e.g. the per-host limit); the duplicate
+    # needs one of its own.
+    after = DEPENDENCY_POLICIES[dependency].get('hedgeAfter') if after is None else after
+    started = queue.Queue(maxsize=1)
+    first = submit(hedge_pool, hedge_attempt(fn, started))
+    if not after:
+        return first.result(timeout=time_left())
+    hedge_budget(dependency).earn()
+    # Timed from when the attempt starts, not from when it was queued.
+    try:
+        wait_for = started.get(timeout=time_left()) + after - monotonic()
+    except queue.Empty:
+        raise DeadlineExceeded(f"{dependency}: request deadline exceeded")
+    left = time_left()
+    wait([first], timeout=max(0.0, wait_for if left is None else min(wait_for, left)))
+    if first.done() or time_left() == 0 or not can_hedge(dependency, slot):
+        return first.result(timeout=time_left())
+    with span('hedge', dependency=dependency) as attrs:
+        second = submit(hedge_pool, hedge_attempt(fn, slot=slot))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=time_left(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded(f"{dependency}: request deadline exceeded")
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                attrs['won'] = future is second
+                return result
+        raise error
@@ -0,0 +1,144 @@
+import base64
+import json
+import os
+from collections import namedtuple
+
+import lambda_function
+from resilience import breaker_states
+
+# Routes and request validation shared by the HTTP servers (server.py and
+# asgi.py), which only differ in how they schedule work and move bytes:
+#
+#   POST /generate          same JSON request/response as the Lambda
+#   POST /generate/stream   one event per pipeline stage as it completes, as
+#                           NDJSON, or as SSE when the client sends
+#                           "Accept: text/event-stream"
+#   POST /jobs              submit an asynchronous job, returns its id
+#   GET  /jobs/<id>         job status and stage-level progress
+#   GET  /jobs/<id>/result  the finished blog, or 202 while it is still running
+#   GET  /images/<name>     stored images, when IMAGE_DELIVERY=url
+#   GET  /healthz           open circuit breakers (asgi.py adds its queue)
+#
+# Every route but the event stream is answered with a Lambda-style result
+# ({'statusCode', 'headers', 'body'}), the same shape lambda_handler returns.
+ALLOWED_ORIGIN = os.environ.get('ALLOWED_ORIGIN', 'https://medbloggen.xyz')
+
+# name is one of 'options', 'health', 'image', 'job', 'generate', 'stream',
+# 'submit' or 'missing'; params are the path segments it needs.
+Route = namedtuple('Route', ['name', 'params'])
+
+
+def match(method: str, path: str) -> Route:
+    path = path.split('?', 1)[0]
+    parts = path.strip('/').split('/')
+    if method == 'OPTIONS':
+        return Route('options', ())
+    if method == 'GET' and path == '/healthz':
+        return Route('health', ())
+    if method == 'GET' and len(parts) == 2 and parts[0] == 'images':
+        return Route('image', (parts[1],))
+    if method == 'GET' and len(parts) in (2, 3) and parts[0] == 'jobs' and parts[2:] in ([], ['result']):
+        return Route('job', (parts[1], 'result' if len(parts) == 3 else 'status'))
+    if method == 'POST' and path == '/generate':
+        return Route('generate', ())
+    if method == 'POST' and path == '/generate/stream':
+        return Route('stream', ())
+    if method == 'POST' and path == '/jobs':
+        return Route('submit', ())
+    return Route('missing', (path,))
+
+
+def cors_headers():
+    return {
+        'Access-Control-Allow-Origin': ALLOWED_ORIGIN,
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Allow-Methods': 'GET,POST,OPTIONS',
+        'Access-Control-Expose-Headers': 'X-Cache',
+    }
+
+
+def json_result(status: int, payload, headers=None):
+    return {'statusCode': status, 'headers': {**(headers or {}), 'Content-Type': 'application/json'},
+            'body': json.dumps(payload)}
+
+
+def encode_result(result):
+    # Lambda-style result -> (status, headers, body bytes). The Lambda's own
+    # CORS headers are replaced by the server's.
+    headers = {
+        name: value for name, value in (result.get('headers') or {}).items()
+        if not name.lower().startswith('access-control-')
+    }
+    body = result.get('body', '')
+    data = base64.b64decode(body) if result.get('isBase64Encoded') else body.encode('utf-8')
+    if data:
+        headers.setdefault('Content-Type', 'application/json')
+    return result['statusCode'], {**headers, 'Content-Length': len(data), **cors_headers()}, data
+
+
+def parse_object(body: str):
+    # Returns (request, error message) for a JSON object body.
+    try:
+        request = json.loads(body)
+    except json.JSONDecodeError:
+        return None, 'Invalid JSON in request body'
+    if not isinstance(request, dict):
+        return None, 'Request body must be a JSON object'
+    return request, None
+
+
+def stream_request(body: str):
+    # Validates a /generate/stream body; returns (request, error message).
+    request, error = parse_object(body)
+    if error:
+        return None, error
+    if 'drugName' not in request or 'drugDetails' not in request:
+        return None, "'drugName' or 'drugDetails' not found in body"
+    if request.get('imageMode') and request['imageMode'] not in lambda_function.IMAGE_MODES:
+        return None, f"'imageMode' must be one of {list(lambda_function.IMAGE_MODES)}"
+    return request, None
+
+
+def stream_events(request):
+    return lambda_function.generate_blog_events(
+        request['drugName'],
+        request['drugDetails'],
+        image_mode=request.get('imageMode'),
+        bypass_cache=bool(request.get('bypassCache', False))
+    )
+
+
+def format_event(event, sse: bool) -> bytes:
+    if sse:
+        return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n".encode('utf-8')
+    return (json.dumps(event) + "\n").encode('utf-8')
+
+
+def stream_content_type(headers) -> str:
+    # headers: lower-cased names.
+    return 'text/event-stream' if 'text/event-stream' in headers.get('accept', '') else 'application/x-ndjson'
+
+
+def health():
+    return {'openBreakers': breaker_states()}
+
+
+def respond(route: Route, body: str = '', headers=None):
+    # Lambda-style result for every route but 'options' and 'stream'. headers:
+    # lower-cased names. Blocks for as long as the pipeline runs.
+    if route.name == 'health':
+        return json_result(200, health())
+    if route.name == 'image':
+        return lambda_function.image_response(route.params[0], headers or {})
+    if route.name == 'job':
+        job_id, action = route.params
+        return lambda_function.lambda_handler({'body': json.dumps({'action': action, 'jobId': job_id})}, None)
+    if route.name == 'generate':
+        return lambda_function.lambda_handler({'body': body}, None)
+    if route.name == 'submit':
+        request, error = parse_object(body)
+        if error:
+            return json_result(400, {'error': error})
+        request['action'] = 'submit'
+        return lambda_function.lambda_handler({'body': json.dumps(request)}, None)
+    return json_result(404, {'error': f"No route for {route.params[0] if route.params else ''}"})
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Local HTTP entry point for the blog pipeline, on the standard library's
+# threading server. Routes are in routes.py.
+#
+#   python server.py --host 0.0.0.0 --port 8080
+#
+# asgi.py serves the same routes with a bounded worker pool and request queue,
+# for running as a long-lived service.
+
+import argparse
+import logging
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import routes
+
+logger = logging.getLogger()
+
+
+class BlogRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def request_headers(self):
+        return {name.lower(): value for name, value in self.headers.items()}
+
+    def send_result(self, result):
+        status, headers, data = routes.encode_result(result)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> str:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8')
+
+    def handle_route(self, method: str):
+        route = routes.match(method, self.path)
+        if route.name == 'options':
+            self.send_result({'statusCode': 204, 'body': ''})
+        elif route.name == 'stream':
+            self.stream_events()
+        else:
+            body = self.read_body() if method == 'POST' else ''
+            self.send_result(routes.respond(route, body, self.request_headers()))
+
+    def do_OPTIONS(self):
+        self.handle_route('OPTIONS')
+
+    def do_GET(self):
+        self.handle_route('GET')
+
+    def do_POST(self):
+        self.handle_route('POST')
+
+    def stream_events(self):
+        request, error = routes.stream_request(self.read_body())
+        if error:
+            self.send_result(routes.json_result(400, {'error': error}))
+            return
+
+        events = routes.stream_events(request)
+        content_type = routes.stream_content_type(self.request_headers())
+        sse = content_type == 'text/event-stream'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in routes.cors_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def write_event(event):
+            data = routes.format_event(event, sse)
+            self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        try:
+            for event in events:
+                write_event(event)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("Client disconnected from event stream")
+            return
+        except Exception as e:
+            logger.error(f"Unexpected error while streaming: {str(e)}", exc_info=True)
+            write_event({'event': 'error', 'error': str(e)})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the blog pipeline over HTTP.')
+    parser.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', '8080')))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = ThreadingHTTPServer((args.host, args.port), BlogRequestHandler)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import threading
+from time import sleep
+
+import pytest
+
+from cache import SingleFlight, SQLiteCache
+
+
+def test_single_flight_shares_the_leaders_error():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    errors = []
+
+    def fail():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        raise ValueError('upstream down')
+
+    def follow():
+        try:
+            flight.do('key', fail)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=follow)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=follow) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    sleep(0.2)  # let the followers reach the in-flight call
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert len(errors) == 4
+    assert all(str(e) == 'upstream down' for e in errors)
+
+
+def test_single_flight_forgets_failed_calls():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError('once')
+
+    with pytest.raises(ValueError):
+        flight.do('key', fail)
+    assert flight.calls == {}
+    assert flight.do('key', lambda: 42) == (42, False)
+
+
+def test_sqlite_cache_errors_are_counted_not_raised(tmp_path):
+    cache = SQLiteCache('test', path=str(tmp_path / 'test.sqlite3'))
+    cache.set('a', {'value': 1})
+    assert cache.get('a') == {'value': 1}
+    cache.conn.close()
+
+    cache.set('b', 2)
+    assert cache.get('a') is None
+    assert cache.stats.as_dict()['errors'] == 2
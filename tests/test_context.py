@@ -0,0 +1,51 @@
+from context import build_context, estimate_tokens, is_boilerplate, split_sentences
+
+PAGE = "\n".join([
+    "Skip to main content",
+    "Home",
+    "Metformin is the first-line treatment for type 2 diabetes in most adults.",
+    "Common side effects of metformin include nausea and diarrhea in 20 percent of patients.",
+    "We use cookies to improve your experience.",
+    "The weather in the valley was pleasant all week long this spring.",
+    "© 2024 Example Health. All rights reserved.",
+])
+
+
+def test_split_sentences_drops_fragments_and_boilerplate():
+    sentences = split_sentences(PAGE)
+    assert "Home" not in sentences
+    assert not any('cookies' in sentence or 'rights reserved' in sentence for sentence in sentences)
+    assert sentences[0].startswith("Metformin is the first-line")
+
+
+def test_boilerplate_is_judged_on_short_lines_only():
+    assert is_boilerplate("Subscribe to our newsletter")
+    long_line = ("Patients who subscribe to a pharmacy refill program were more likely to keep taking metformin "
+                 "every day over the two years of the study, compared with those who refilled by hand.")
+    assert not is_boilerplate(long_line)
+    assert not is_boilerplate("The javascriptless version of the site")
+
+
+def test_build_context_keeps_repeated_sentences_once():
+    repeated = "Metformin lowers blood glucose by reducing liver glucose production."
+    condensed, _ = build_context([repeated, repeated + " Metformin is taken with meals."], 'metformin', 1000)
+    assert condensed[0] == repeated
+    assert condensed[1] == "Metformin is taken with meals."
+
+
+def test_build_context_stays_within_budget_and_keeps_order():
+    budget = 40
+    condensed, report = build_context([PAGE, PAGE.replace('Metformin', 'Glipizide')], 'metformin', budget)
+    used = sum(estimate_tokens(sentence) + 1 for text in condensed for sentence in split_sentences(text))
+    assert used <= budget
+    assert report['tokensAfter'] <= budget
+    assert report['tokensSaved'] == report['tokensBefore'] - report['tokensAfter']
+    # The sentences about the focus drug win the budget.
+    assert 'metformin' in condensed[0].lower()
+    assert 'weather' not in condensed[0]
+
+
+def test_build_context_returns_one_text_per_source():
+    condensed, report = build_context(["", PAGE], 'metformin', 0)
+    assert condensed == ["", ""]
+    assert report['tokensAfter'] == 0
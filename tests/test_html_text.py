@@ -0,0 +1,39 @@
+import pytest
+
+from html_text import extract_visible_text
+
+BeautifulSoup = pytest.importorskip('bs4').BeautifulSoup
+
+PAGES = [
+    "<html><head><title>Metformin &amp; you</title><style>p{color:red}</style></head>"
+    "<body><nav><a href='/'>Home</a></nav><p>Metformin lowers glucose.</p>"
+    "<script>var x = '<p>not text</p>';</script><p>  Take it&nbsp;with meals. </p><!-- ad --></body></html>",
+    "<!DOCTYPE html><div>One<br/>Two<span> three </span></div><template><p>hidden</p></template>"
+    "<ruby>漢<rt>kan</rt></ruby><p>Dose: 500&#8239;mg</p>",
+    "<p>Unclosed <b>bold <i>italic</p><p>café crème",
+]
+
+
+def baseline(html: str, limit: int) -> str:
+    return BeautifulSoup(html, 'html.parser').get_text(strip=True, separator='\n')[:limit]
+
+
+def chunked(data: bytes, size: int):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize('html', PAGES)
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_matches_beautifulsoup(html, chunk_size):
+    assert extract_visible_text(chunked(html.encode('utf-8'), chunk_size), limit=1500) == baseline(html, 1500)
+
+
+@pytest.mark.parametrize('limit', [5, 20, 40])
+def test_stops_at_the_limit_like_truncated_beautifulsoup(limit):
+    html = PAGES[0]
+    assert extract_visible_text(chunked(html.encode('utf-8'), 16), limit=limit) == baseline(html, limit)
+
+
+def test_stops_reading_after_max_bytes():
+    html = "<p>first</p>" + "<p>" + "x" * 100 + "</p>"
+    assert extract_visible_text(chunked(html.encode('utf-8'), 4), max_bytes=12) == "first"
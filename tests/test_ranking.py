@@ -0,0 +1,68 @@
+from ranking import normalize_url, rank_results, site_domain
+
+
+def hit(url, title='', description=''):
+    return {'url': url, 'title': title, 'description': description}
+
+
+def test_normalize_url_ignores_presentation_differences():
+    assert normalize_url('https://www.Drugs.com/metformin.html/#dosage') == normalize_url('http://drugs.com/metformin.html')
+    assert normalize_url('https://example.com:443/a?b=2&a=1') == normalize_url('https://example.com/a?a=1&b=2')
+    assert normalize_url('https://example.com') == normalize_url('https://example.com/')
+
+
+def test_normalize_url_drops_only_tracking_parameters():
+    assert normalize_url('https://example.com/a?utm_source=x&gclid=1&id=7') == normalize_url('https://example.com/a?id=7')
+    assert normalize_url('https://example.com/a?referenceDrug=metformin') != normalize_url('https://example.com/a')
+    assert normalize_url('https://example.com:8080/a') != normalize_url('https://example.com/a')
+
+
+def test_site_domain_handles_second_level_registrations():
+    assert site_domain('https://www.nhs.uk/medicines/') == 'nhs.uk'
+    assert site_domain('https://www.example.co.uk/a') == 'example.co.uk'
+    assert site_domain('https://ncbi.nlm.nih.gov/pmc') == 'nih.gov'
+
+
+def test_rank_results_merges_duplicates_across_queries():
+    first = [hit('https://www.example.com/metformin?utm_source=a', 'Metformin alternatives')]
+    second = [hit('https://example.com/metformin', 'Metformin alternatives')]
+    ranked = rank_results([first, second], 'Metformin', limit=5, trusted=set())
+    assert len(ranked) == 1
+    assert ranked[0]['_queries'] == 2
+
+
+def test_rank_results_prefers_trusted_and_relevant_hits():
+    results = [
+        hit('https://blog.example/metformin', 'Metformin vs glipizide'),
+        hit('https://medlineplus.gov/druginfo/metformin', 'Metformin'),
+        hit('https://unrelated.example/diet', 'Ten diet tips'),
+    ]
+    ranked = rank_results([results], 'Metformin', limit=3, trusted={'medlineplus.gov'})
+    assert [result['url'] for result in ranked] == [
+        'https://medlineplus.gov/druginfo/metformin',
+        'https://blog.example/metformin',
+        'https://unrelated.example/diet',
+    ]
+    assert ranked[0]['_score'] > ranked[1]['_score']
+
+
+def test_rank_results_limits_each_domain_until_slots_are_left():
+    results = [
+        hit('https://drugs.com/a', 'Metformin alternatives'),
+        hit('https://drugs.com/b', 'Metformin alternatives'),
+        hit('https://example.org/c', 'Metformin'),
+    ]
+    ranked = rank_results([results], 'Metformin', limit=2, per_domain=1, trusted=set())
+    assert {site_domain(result['url']) for result in ranked} == {'drugs.com', 'example.org'}
+    # Too few distinct domains: the overflow fills the remaining slot.
+    ranked = rank_results([results], 'Metformin', limit=3, per_domain=1, trusted=set())
+    assert len(ranked) == 3
+
+
+def test_rank_results_skips_unreadable_documents_while_others_remain():
+    results = [
+        hit('https://fda.gov/label.pdf', 'Metformin label'),
+        hit('https://example.org/metformin', 'Metformin'),
+    ]
+    ranked = rank_results([results], 'Metformin', limit=1, trusted={'fda.gov'})
+    assert ranked[0]['url'] == 'https://example.org/metformin'
@@ -0,0 +1,68 @@
+import pytest
+
+import rate_limiter
+from rate_limiter import TokenBucket, parse_retry_after
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter, 'monotonic', clock)
+    monkeypatch.setattr(rate_limiter, 'sleep', clock.sleep)
+    return clock
+
+
+def test_bucket_spends_burst_then_paces(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+    assert bucket.acquire()
+    assert bucket.acquire()
+    assert clock.slept == []
+    assert bucket.acquire()
+    assert clock.slept == [pytest.approx(0.5)]
+
+
+def test_pause_blocks_until_the_window_has_passed(clock):
+    bucket = TokenBucket(rate=1, burst=3)
+    bucket.pause(5)
+    assert not bucket.acquire(timeout=4)
+    assert bucket.acquire(timeout=6)
+    assert clock.now == pytest.approx(1005)
+
+
+def test_pause_releases_one_token_and_refills_from_the_window_end(clock):
+    bucket = TokenBucket(rate=1, burst=3)
+    bucket.pause(5)
+    clock.now += 5
+    assert bucket.acquire(timeout=0)
+    # The rest of the bank hasn't refilled during the pause.
+    assert not bucket.acquire(timeout=0.5)
+    clock.now += 1
+    assert bucket.acquire(timeout=0)
+
+
+def test_pause_never_shortens_an_earlier_one(clock):
+    bucket = TokenBucket(rate=1, burst=1)
+    bucket.pause(10)
+    bucket.pause(2)
+    assert not bucket.acquire(timeout=9)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after('-1') == 0.0
+    assert parse_retry_after(None, default=2) == 2
+    assert parse_retry_after('soon', default=2) == 2
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
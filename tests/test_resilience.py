@@ -0,0 +1,182 @@
+import threading
+
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, HedgeBudget, UpstreamError, call, can_hedge, hedge_attempt
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(resilience, '_breakers', {})
+    monkeypatch.setattr(resilience, '_hedge_budgets', {})
+    monkeypatch.setattr(resilience, '_hedge_busy', 0)
+    monkeypatch.setattr(resilience, 'sleep', lambda seconds: None)
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    circuit = CircuitBreaker('test', failures=3, reset=30)
+    for _ in range(2):
+        assert circuit.allow()
+        circuit.record_failure()
+    assert circuit.state == 'closed'
+    circuit.record_failure()
+    assert circuit.state == 'open'
+    assert not circuit.allow()
+
+
+def test_breaker_success_resets_failure_count(clock):
+    circuit = CircuitBreaker('test', failures=2, reset=30)
+    circuit.record_failure()
+    circuit.record_success()
+    circuit.record_failure()
+    assert circuit.state == 'closed'
+
+
+def test_breaker_half_open_lets_one_probe_through(clock):
+    circuit = CircuitBreaker('test', failures=1, reset=30)
+    circuit.record_failure()
+    clock.now += 29
+    assert not circuit.allow()
+    clock.now += 1
+    assert circuit.allow()
+    assert circuit.state == 'half_open'
+    assert not circuit.allow()  # the probe is still out
+
+
+def test_breaker_probe_outcome_closes_or_reopens(clock):
+    circuit = CircuitBreaker('test', failures=1, reset=30)
+    circuit.record_failure()
+    clock.now += 30
+    assert circuit.allow()
+    circuit.record_failure()
+    assert circuit.state == 'open'
+    assert not circuit.allow()
+
+    clock.now += 30
+    assert circuit.allow()
+    circuit.record_success()
+    assert circuit.state == 'closed'
+    assert circuit.allow()
+
+
+def test_breaker_release_frees_the_probe(clock):
+    circuit = CircuitBreaker('test', failures=1, reset=30)
+    circuit.record_failure()
+    clock.now += 30
+    assert circuit.allow()
+    circuit.release()
+    assert circuit.state == 'half_open'
+    assert circuit.allow()
+
+
+def test_call_counts_retryable_failures(fresh_state):
+    attempts = []
+
+    def fail(timeout):
+        attempts.append(timeout)
+        raise UpstreamError('brave', 503)
+
+    with pytest.raises(UpstreamError):
+        call('brave', fail, retries=2)
+    assert len(attempts) == 3
+    assert resilience.breaker('brave').failures == 3
+
+
+def test_call_retries_throttling_without_tripping_the_breaker(fresh_state):
+    attempts = []
+
+    def throttled(timeout):
+        attempts.append(timeout)
+        raise UpstreamError('brave', 429, retry_after=0)
+
+    for _ in range(3):
+        with pytest.raises(UpstreamError):
+            call('brave', throttled, retries=2, is_throttled=resilience.is_rate_limited)
+    assert len(attempts) == 9
+    circuit = resilience.breaker('brave')
+    assert circuit.failures == 0
+    assert circuit.state == 'closed'
+
+
+def test_call_does_not_retry_other_errors(fresh_state):
+    attempts = []
+
+    def bad_request(timeout):
+        attempts.append(timeout)
+        raise UpstreamError('brave', 400)
+
+    with pytest.raises(UpstreamError):
+        call('brave', bad_request, retries=2)
+    assert len(attempts) == 1
+    assert resilience.breaker('brave').failures == 0
+
+
+def test_hedge_budget_earns_a_share_per_call_up_to_burst():
+    budget = HedgeBudget(ratio=0.25, burst=2)
+    assert budget.spend()
+    assert budget.spend()
+    assert not budget.spend()
+    for _ in range(3):
+        budget.earn()
+    assert not budget.spend()
+    budget.earn()
+    assert budget.spend()
+    for _ in range(100):
+        budget.earn()
+    assert budget.tokens == 2
+
+
+def test_can_hedge_takes_the_slot_only_when_it_hedges(fresh_state, monkeypatch):
+    monkeypatch.setitem(resilience.DEPENDENCY_POLICIES, 'pages',
+                        {**resilience.DEPENDENCY_POLICIES['pages'], 'hedgeBudget': 0, 'hedgeBurst': 1})
+    slot = threading.BoundedSemaphore(1)
+    assert can_hedge('pages', slot)
+    assert not slot.acquire(blocking=False)  # held for the hedge
+    slot.release()
+
+    # No budget left: the slot is handed back.
+    assert not can_hedge('pages', slot)
+    assert slot.acquire(blocking=False)
+    # No free slot: the budget isn't spent.
+    resilience.hedge_budget('pages').tokens = 1
+    assert not can_hedge('pages', slot)
+    assert resilience.hedge_budget('pages').tokens == 1
+    slot.release()
+
+
+def test_can_hedge_refuses_when_hedge_pool_is_busy(fresh_state, monkeypatch):
+    monkeypatch.setattr(resilience, '_hedge_busy', resilience.HEDGE_WORKERS)
+    slot = threading.BoundedSemaphore(1)
+    assert not can_hedge('pages', slot)
+    assert slot.acquire(blocking=False)
+    assert resilience.hedge_budget('pages').tokens == resilience.DEPENDENCY_POLICIES['pages']['hedgeBurst']
+
+
+def test_hedge_attempt_releases_slot_and_busy_count_on_error(fresh_state):
+    slot = threading.BoundedSemaphore(1)
+    slot.acquire()
+
+    def fail():
+        assert resilience._hedge_busy == 1
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        hedge_attempt(fail, slot=slot)()
+    assert resilience._hedge_busy == 0
+    assert slot.acquire(blocking=False)
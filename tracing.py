@@ -0,0 +1,123 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+# Lightweight per-request tracing. The active trace lives in a context
+# variable; work handed to thread pools must go through submit() so it is
+# recorded against the request that started it. With no active trace, spans
+# cost a context-variable lookup and nothing else.
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    def __init__(self, name: str = 'request'):
+        self.name = name
+        self.started = perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def elapsed_ms(self) -> float:
+        return round((perf_counter() - self.started) * 1000, 1)
+
+    def summary(self, include_spans: bool = True):
+        stages = {}
+        usage = {'inputTokens': 0, 'outputTokens': 0}
+        streams = []
+        context = {}
+        upstream = {}
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['startMs'])
+        for span in spans:
+            stage = stages.setdefault(span['name'], {'count': 0, 'totalMs': 0.0, 'maxMs': 0.0})
+            stage['count'] += 1
+            stage['totalMs'] = round(stage['totalMs'] + span['durationMs'], 1)
+            stage['maxMs'] = max(stage['maxMs'], span['durationMs'])
+            usage['inputTokens'] += span['attrs'].get('inputTokens', 0)
+            usage['outputTokens'] += span['attrs'].get('outputTokens', 0)
+            if 'firstTokenMs' in span['attrs']:
+                streams.append({
+                    'stage': span['attrs'].get('stage'),
+                    'firstTokenMs': span['attrs']['firstTokenMs'],
+                    'tokensPerSec': span['attrs'].get('tokensPerSec'),
+                })
+            if 'tokensSaved' in span['attrs']:
+                saved = context.setdefault(span['attrs'].get('stage'), {'tokensBefore': 0, 'tokensAfter': 0, 'tokensSaved': 0})
+                for field in saved:
+                    saved[field] += span['attrs'][field]
+            if span['name'] in ('upstream', 'hedge'):
+                calls = upstream.setdefault(span['attrs'].get('dependency'), {
+                    'calls': 0, 'attempts': 0, 'errors': 0, 'circuitOpen': 0, 'hedged': 0, 'hedgeWins': 0
+                })
+                if span['name'] == 'upstream':
+                    calls['calls'] += 1
+                    calls['attempts'] += span['attrs'].get('attempts', 0)
+                    calls['errors'] += 'error' in span['attrs']
+                    calls['circuitOpen'] += bool(span['attrs'].get('circuitOpen'))
+                else:
+                    calls['hedged'] += 1
+                    calls['hedgeWins'] += bool(span['attrs'].get('won'))
+        summary = {
+            'totalMs': self.elapsed_ms(), 'stages': stages, 'usage': usage, 'streams': streams, 'context': context,
+            'upstream': upstream
+        }
+        if include_spans:
+            summary['spans'] = spans
+        return summary
+
+
+@contextmanager
+def trace_request(name: str = 'request'):
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    # Yields the attribute dict so callers can attach results (token counts,
+    # cache hits, ...) before the span closes.
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    start = perf_counter()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs['error'] = type(e).__name__
+        raise
+    finally:
+        trace.add({
+            'name': name,
+            'startMs': round((start - trace.started) * 1000, 1),
+            'durationMs': round((perf_counter() - start) * 1000, 1),
+            'attrs': attrs,
+        })
+
+
+def traced(name: str):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def submit(pool, fn, *args, **kwargs):
+    context = contextvars.copy_context()
+    return pool.submit(context.run, fn, *args, **kwargs)